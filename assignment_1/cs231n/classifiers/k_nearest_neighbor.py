@@ -1,26 +1,164 @@
+from __future__ import print_function
+
+from collections import namedtuple
+import multiprocessing
+import os
+import pickle
+import time
+
 import numpy as np
+from scipy.spatial.distance import cdist
+
+from cs231n.classifiers.knn_index import INDEX_TYPES, append_rows, kmeans
+from cs231n.grid_search import blas_limited_pool
+from cs231n.shared_arrays import (attach_array, attach_attributes, release,
+                                  share_array, share_attributes)
+
+# Default number of bytes the tiled distance engine may use for its scratch
+# space (distance tile, merge candidates and partition indices).
+DEFAULT_MEMORY_BUDGET = 256 * 1024 ** 2
+
+# Distance metrics supported by KNearestNeighbor.
+METRICS = ('l2', 'l1', 'cosine')
+
+# Training set reduction methods of KNearestNeighbor.reduce.
+REDUCTION_METHODS = ('condensed', 'edited', 'kmeans')
+
+# Translation applied by ann_recall_report to mimic raw, uncentered pixels.
+RAW_PIXEL_SHIFT = 128.0
 
 class KNearestNeighbor(object):
-  """ a kNN classifier with L2 distance """
+  """ a kNN classifier with L2, L1 or cosine distance """
 
-  def __init__(self):
-    pass
+  def __init__(self, index=None, metric='l2', dtype=None, **index_params):
+    """
+    Inputs:
+    - index: None for brute-force search, or the name of a search index to
+      build at training time, one of the keys of INDEX_TYPES ('balltree',
+      'kdtree', 'lsh', 'ivfpq'). Tree indexes are exact and pay off on
+      low-dimensional data, up to about 16 dimensions for 'kdtree' and 64
+      for 'balltree'; 'lsh' and 'ivfpq' are approximate and meant for
+      high-dimensional data, see ann_recall_report for tuning them. 'ivfpq'
+      compresses the training set and does not keep self.X_train, so only
+      the index can answer queries.
+    - metric: The distance to use, one of METRICS: 'l2' (Euclidean), 'l1'
+      (Manhattan) or 'cosine' (one minus the cosine similarity; points of
+      norm zero are at distance 1 from everything). The search indexes only
+      support 'l2'.
+    - dtype: If given, such as np.float32, the dtype in which the training
+      data is stored and distances are computed: training data is converted
+      once and test points one block at a time, so float32 search never
+      upcasts to float64. None keeps the dtype of the training data.
+    - index_params: Keyword arguments for the index, e.g. leaf_size.
+    """
+    if index is not None and index not in INDEX_TYPES:
+      raise ValueError('Unknown index "%s"' % index)
+    if metric not in METRICS:
+      raise ValueError('Unknown metric "%s"' % metric)
+    if index is not None and metric != 'l2':
+      raise ValueError('Search indexes only support the l2 metric')
+    self.index_type = index
+    self.metric = metric
+    self.dtype = dtype
+    self.index_params = index_params
+    self.index = None
 
-  def train(self, X, y):
+  def train(self, X, y, float32=False):
     """
     Train the classifier. For k-nearest neighbors this is just 
-    memorizing the training data.
+    memorizing the training data, plus caching the squared norm of every
+    training point so that queries do not recompute them.
+
+    Integer training data, such as the raw uint8 pixels returned by
+    load_CIFAR10(dtype=np.uint8), is kept as it is: the norms are cached as
+    exact int64 values and the tiled engine computes exact squared l2
+    distances, so the neighbors match exact arithmetic while the training
+    set takes a fraction of the memory of a float64 copy.
 
     Inputs:
     - X: A numpy array of shape (num_train, D) containing the training data
       consisting of num_train samples each of dimension D.
     - y: A numpy array of shape (N,) containing the training labels, where
          y[i] is the label for X[i].
+    - float32: If true, also keep a float32 copy of the training data. The
+      no-loop prediction path then computes distances with float32 BLAS
+      calls; see the rerank argument of predict for keeping results exact.
     """
+    if self.dtype is not None:
+      X = np.ascontiguousarray(X, dtype=self.dtype)
     self.X_train = X
     self.y_train = y
+    # growth buffers of partial_train are only created when needed
+    for name in [name for name in vars(self) if name.endswith('_buffer')]:
+      delattr(self, name)
+    # sorted distinct labels and the position of every label among them,
+    # used for the vectorized vote
+    self.classes, self.y_codes = np.unique(y, return_inverse=True)
+    self.train_sq_norms = None
+    self.X_train32 = None
+    self.train_sq_norms32 = None
+    if self.index_type is not None:
+      self.index = INDEX_TYPES[self.index_type](**self.index_params)
+      self.index.build(X)
+      if getattr(self.index, 'compressed', False):
+        # a compressed index answers queries on its own; dropping the
+        # reference lets the raw training data be freed
+        self.X_train = None
+        return
+
+    self.train_sq_norms = _sq_norms(X)
+    if float32:
+      self.X_train32 = np.ascontiguousarray(X, dtype=np.float32)
+      self.train_sq_norms32 = self.train_sq_norms.astype(np.float32)
     
-  def predict(self, X, k=1, num_loops=0):
+  def partial_train(self, X, y):
+    """
+    Add training points to a trained classifier (or train it if it is not).
+
+    The training data, labels and cached norms are kept at the front of
+    buffers whose capacity doubles when full, and the search index, if any,
+    is updated incrementally, so adding a batch costs amortized O(batch)
+    instead of copying the whole training set.
+
+    Inputs:
+    - X: A numpy array of shape (num_new, D) of new training points.
+    - y: A numpy array of shape (num_new,) of their labels.
+    """
+    if getattr(self, 'y_train', None) is None:
+      self.train(X, y)
+      return
+    if self.dtype is not None:
+      X = np.asarray(X, dtype=self.dtype)
+
+    self._y_buffer, self.y_train = append_rows(
+      getattr(self, '_y_buffer', None), self.y_train, y)
+    new_codes = np.searchsorted(self.classes, y)
+    if np.all(new_codes < len(self.classes)) and \
+       np.all(self.classes[np.minimum(new_codes, len(self.classes) - 1)] == y):
+      self._codes_buffer, self.y_codes = append_rows(
+        getattr(self, '_codes_buffer', None), self.y_codes, new_codes)
+    else:
+      # a label never seen before shifts the codes of the larger labels
+      self.classes, self.y_codes = np.unique(self.y_train, return_inverse=True)
+      self._codes_buffer = None
+
+    if self.X_train is not None:
+      self._X_buffer, self.X_train = append_rows(
+        getattr(self, '_X_buffer', None), self.X_train, X)
+      self._sq_norms_buffer, self.train_sq_norms = append_rows(
+        getattr(self, '_sq_norms_buffer', None), self.train_sq_norms,
+        _sq_norms(X))
+    if self.X_train32 is not None:
+      self._X32_buffer, self.X_train32 = append_rows(
+        getattr(self, '_X32_buffer', None), self.X_train32, X)
+      self._sq_norms32_buffer, self.train_sq_norms32 = append_rows(
+        getattr(self, '_sq_norms32_buffer', None), self.train_sq_norms32,
+        self.train_sq_norms[self.train_sq_norms.shape[0] - X.shape[0]:])
+    if self.index is not None:
+      self.index.add(X, self.X_train)
+
+  def predict(self, X, k=1, num_loops=0, memory_budget=None, rerank=None,
+              n_jobs=1):
     """
     Predict labels for test data using this classifier.
 
@@ -30,22 +168,221 @@ class KNearestNeighbor(object):
     - k: The number of nearest neighbors that vote for the predicted labels.
     - num_loops: Determines which implementation to use to compute distances
       between training points and testing points.
+      If the classifier was built with a search index, num_loops=0 queries
+      the index instead. num_loops=1 and 2 only support the l2 metric.
+    - memory_budget: If given, the number of bytes of scratch space the
+      distance computation may use. The neighbors are then found tile by tile
+      with compute_neighbors_tiled and the full distance matrix is never
+      built. Only used with num_loops=0.
+    - rerank: Only used when the classifier was trained with float32=True.
+      If given, the rerank >= k closest candidates found in float32 are
+      re-scored in float64 and the best k of them vote, so that the result
+      matches the float64 path.
+    - n_jobs: Number of worker processes. If above 1, the training data and
+      X are placed in shared memory once and the test points are split
+      among the workers, each running this method with n_jobs=1.
 
     Returns:
     - y: A numpy array of shape (num_test,) containing predicted labels for the
       test data, where y[i] is the predicted label for the test point X[i].  
     """
+    if n_jobs > 1:
+      return self._predict_parallel(X, n_jobs, k=k, num_loops=num_loops,
+                                    memory_budget=memory_budget,
+                                    rerank=rerank)
+
+    if num_loops == 0 and self.index is not None:
+      neighbors, _ = self.index.query(X, k=k)
+      return self._vote(neighbors)
+
+    if num_loops == 0 and (memory_budget is not None or
+                           self.X_train32 is not None):
+      if memory_budget is None:
+        memory_budget = DEFAULT_MEMORY_BUDGET
+      neighbors, _ = self.compute_neighbors_tiled(X, k=k,
+                                                  memory_budget=memory_budget,
+                                                  rerank=rerank)
+      return self._vote(neighbors)
+
     if num_loops == 0:
       dists = self.compute_distances_no_loops(X)
+    elif num_loops not in (1, 2):
+      raise ValueError('Invalid value %d for num_loops' % num_loops)
+    elif self.metric != 'l2':
+      raise ValueError('num_loops=%d only supports the l2 metric' % num_loops)
     elif num_loops == 1:
       dists = self.compute_distances_one_loop(X)
-    elif num_loops == 2:
-      dists = self.compute_distances_two_loops(X)
     else:
-      raise ValueError('Invalid value %d for num_loops' % num_loops)
+      dists = self.compute_distances_two_loops(X)
 
     return self.predict_labels(dists, k=k)
 
+  def reduce(self, method='condensed', k=3, prototypes_per_class=10,
+             batch_size=256, seed=0, memory_budget=DEFAULT_MEMORY_BUDGET):
+    """
+    Build a classifier on a smaller training set, so that prediction, whose
+    cost grows linearly with num_train, gets cheaper. Use reduction_report to
+    measure what the reduction costs in accuracy.
+
+    Inputs:
+    - method: One of REDUCTION_METHODS:
+      'condensed': Hart's condensed nearest neighbor. Starting from one point
+      per class, every training point that the kept points misclassify with
+      1-NN is kept, until the kept points classify the whole training set
+      correctly. Points are visited in a random order, batch_size at a time.
+      'edited': Wilson's edited nearest neighbor. Drops every training point
+      that its k nearest other training points misclassify, which removes
+      noise and class overlap rather than redundancy.
+      'kmeans': Replaces the points of every class by the centroids of
+      prototypes_per_class k-means clusters of that class.
+    - k: Number of neighbors voting in 'edited'.
+    - prototypes_per_class: Number of centroids per class for 'kmeans'.
+    - batch_size: Number of points checked at a time by 'condensed'.
+    - seed: Seed for the visiting order of 'condensed' and for 'kmeans'.
+    - memory_budget: Approximate number of bytes of scratch space to use.
+
+    Returns:
+    - A new KNearestNeighbor with the metric and search index of this one,
+      trained on the reduced training set.
+    """
+    if self.X_train is None:
+      raise ValueError('reduce needs the training data, which a compressed '
+                       'index does not keep')
+    if method == 'condensed':
+      keep = self._condensed_subset(batch_size, seed, memory_budget)
+      X, y = self.X_train[keep], self.y_train[keep]
+    elif method == 'edited':
+      num_train = self.X_train.shape[0]
+      k = min(k, num_train - 1)
+      # every point is its own group, so it is not its own neighbor
+      groups = np.arange(num_train)
+      neighbors, _ = _top_k_tiled(self.X_train, self.X_train,
+                                  self.train_sq_norms, k, memory_budget,
+                                  self.metric, groups, groups)
+      keep = np.nonzero(self._vote(neighbors) == self.y_train)[0]
+      X, y = self.X_train[keep], self.y_train[keep]
+    elif method == 'kmeans':
+      X, y = [], []
+      for code, label in enumerate(self.classes):
+        members = self.X_train[self.y_codes == code]
+        centroids, _ = kmeans(members, prototypes_per_class, seed=seed,
+                              memory_budget=memory_budget)
+        X.append(centroids)
+        y.append(np.repeat(label, centroids.shape[0]))
+      X, y = np.concatenate(X), np.concatenate(y)
+    else:
+      raise ValueError('Unknown reduction method "%s"' % method)
+
+    reduced = KNearestNeighbor(index=self.index_type, metric=self.metric,
+                               dtype=self.dtype, **self.index_params)
+    reduced.train(X, y, float32=self.X_train32 is not None)
+    return reduced
+
+  def _condensed_subset(self, batch_size, seed, memory_budget):
+    """
+    Indices of the training points kept by condensed nearest neighbor.
+
+    Rather than re-scanning the kept points, the distance of every training
+    point to its closest kept point is maintained and only updated with the
+    points added, so the whole reduction costs one distance per (training
+    point, kept point) pair.
+    """
+    num_train = self.X_train.shape[0]
+    rng = np.random.RandomState(seed)
+    order = rng.permutation(num_train)
+    kept = np.zeros(num_train, dtype=bool)
+    nearest_d = np.full(num_train, np.inf)
+    nearest_code = np.full(num_train, -1)
+
+    def add(points):
+      kept[points] = True
+      neighbors, dists = _top_k_tiled(self.X_train, self.X_train[points],
+                                      self.train_sq_norms[points], 1,
+                                      memory_budget, self.metric)
+      closer = dists[:, 0] < nearest_d
+      nearest_d[closer] = dists[closer, 0]
+      nearest_code[closer] = self.y_codes[points[neighbors[closer, 0]]]
+
+    # the first point of every class in the visiting order
+    add(order[np.unique(self.y_codes[order], return_index=True)[1]])
+    changed = True
+    while changed:
+      changed = False
+      for i0 in range(0, num_train, batch_size):
+        batch = order[i0:i0 + batch_size]
+        wrong = batch[(nearest_code[batch] != self.y_codes[batch]) &
+                      ~kept[batch]]
+        if wrong.size > 0:
+          add(wrong)
+          changed = True
+    return np.nonzero(kept)[0]
+
+  def save(self, path):
+    """
+    Write the trained classifier to a directory so that load can bring it
+    back without retraining.
+
+    Every array (training data, labels, cached norms and the arrays of the
+    search index) is written to its own .npy file and everything else to
+    model.pkl, so the arrays can be memory-mapped on load. Private
+    attributes, such as the spare capacity of partial_train, are not saved.
+
+    Inputs:
+    - path: Directory to write to; created if needed. Existing files of a
+      previous save are overwritten.
+    """
+    if not os.path.isdir(path):
+      os.makedirs(path)
+    state = _dump_state(self, path, '', {})
+    with open(os.path.join(path, 'model.pkl'), 'wb') as f:
+      pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+  @staticmethod
+  def load(path, mmap=True):
+    """
+    Load a classifier written by save.
+
+    Inputs:
+    - path: Directory given to save.
+    - mmap: If true, the arrays are memory-mapped read-only instead of read:
+      loading is immediate, pages are read from disk on first use, and
+      processes loading the same files share them through the page cache.
+
+    Returns:
+    - A KNearestNeighbor ready for predict.
+    """
+    with open(os.path.join(path, 'model.pkl'), 'rb') as f:
+      state = pickle.load(f)
+    return _load_state(state, path, 'r' if mmap else None, {})
+
+  def _predict_parallel(self, X, n_jobs, **kwargs):
+    """
+    Run predict over slices of X in a pool of n_jobs processes that share this
+    classifier's arrays and X through shared memory, so nothing of size
+    num_train or num_test is pickled per task. The cores are split between
+    the workers' BLAS threads, so their distance GEMMs do not oversubscribe
+    them.
+    """
+    num_test = X.shape[0]
+    chunk = max(-(-num_test // (4 * n_jobs)), 1)
+    bounds = [(i0, min(i0 + chunk, num_test))
+              for i0 in range(0, num_test, chunk)]
+    model_spec, blocks = share_attributes(self)
+    x_block, x_spec = share_array(X)
+    blocks.append(x_block)
+    try:
+      pool = blas_limited_pool(n_jobs, _init_predict_worker,
+                               (model_spec, x_spec, kwargs),
+                               max(multiprocessing.cpu_count() // n_jobs, 1))
+      try:
+        labels = pool.map(_predict_worker_slice, bounds)
+      finally:
+        pool.close()
+        pool.join()
+    finally:
+      release(blocks)
+    return np.concatenate(labels)
+
   def compute_distances_two_loops(self, X):
     """
     Compute the distance between each test point in X and each training point
@@ -106,7 +443,15 @@ class KNearestNeighbor(object):
     in self.X_train using no explicit loops.
 
     Input / Output: Same as compute_distances_two_loops
+
+    For the l1 and cosine metrics, and for integer training data, the
+    matrix is filled tile by tile by the kernels of the tiled engine instead.
+    Test points are converted to the dtype of floating point training data.
     """
+    if self.metric != 'l2' or _is_integer(self.X_train):
+      return _distances_tiled(X, self.X_train, self.train_sq_norms,
+                              self.metric, DEFAULT_MEMORY_BUDGET)
+    X = X.astype(self.X_train.dtype, copy=False)
     num_test = X.shape[0]
     num_train = self.X_train.shape[0]
     dists = np.zeros((num_test, num_train)) 
@@ -141,7 +486,8 @@ class KNearestNeighbor(object):
     # example sum(test**2) with all such sums for the training set and so on
     quad_term_1 = np.sum ( X ** 2, axis = 1 ).reshape(num_test,1) 
     
-    quad_term_2 = np.sum ( self.X_train**2 , axis = 1 ).reshape(1,num_train)
+    # squared training norms are cached by train
+    quad_term_2 = self.train_sq_norms.reshape(1,num_train)
     
     #sum --> broadcasting prodcues right result
     quad_term = quad_term_1 + quad_term_2 
@@ -152,6 +498,118 @@ class KNearestNeighbor(object):
     #########################################################################
     return dists
 
+  def compute_neighbors_tiled(self, X, k=1,
+                              memory_budget=DEFAULT_MEMORY_BUDGET,
+                              rerank=None):
+    """
+    Find the k nearest training points of each test point in X without ever
+    building the full (num_test, num_train) distance matrix.
+
+    Test and training points are processed in (test block, train block) tiles
+    sized so that the scratch space of one tile stays within memory_budget.
+    Each tile is computed with the kernel of the metric (for l2 the same
+    decomposition as compute_distances_no_loops, for cosine one matrix
+    product scaled by the cached norms, for l1 a compiled pairwise kernel)
+    and merged into a running top-k per test point.
+    If the classifier was trained with float32=True the tiles are computed in
+    float32.
+
+    Inputs:
+    - X: A numpy array of shape (num_test, D) containing test data.
+    - k: The number of nearest neighbors to find.
+    - memory_budget: Approximate number of bytes of scratch space to use.
+    - rerank: If given and the float32 copy is in use, keep the rerank
+      closest candidates of the float32 search and pick the final k among
+      them using exact float64 distances.
+
+    Returns a tuple of:
+    - neighbors: A numpy array of shape (num_test, k) where neighbors[i] holds
+      the indices into self.X_train of the k training points closest to X[i],
+      ordered from closest to farthest.
+    - dists: A numpy array of shape (num_test, k) holding the corresponding
+      distances under self.metric.
+    """
+    num_train = self.X_train.shape[0]
+    k = min(k, num_train)
+    if self.X_train32 is None:
+      return _top_k_tiled(X, self.X_train, self.train_sq_norms, k,
+                          memory_budget, self.metric)
+
+    num_candidates = k if rerank is None else min(max(rerank, k), num_train)
+    neighbors, dists = _top_k_tiled(X, self.X_train32,
+                                    self.train_sq_norms32, num_candidates,
+                                    memory_budget, self.metric)
+    if rerank is None:
+      return neighbors, dists
+    return self._rerank(X, neighbors, k, memory_budget)
+
+  def _rerank(self, X, candidates, k, memory_budget):
+    """
+    Re-score candidate neighbors with exact float64 distances.
+
+    Inputs:
+    - X: A numpy array of shape (num_test, D) containing test data.
+    - candidates: A numpy array of shape (num_test, r) of indices into
+      self.X_train, r >= k.
+    - k: The number of neighbors to keep.
+    - memory_budget: Approximate number of bytes of scratch space to use for
+      the gathered candidate rows.
+
+    Returns a tuple (neighbors, dists) as in compute_neighbors_tiled.
+    """
+    num_test, num_candidates = candidates.shape
+    dim = self.X_train.shape[1]
+    # the gathered rows are the only (block, r, D) array: they are read into
+    # one float64 buffer, a column of candidates at a time if X_train has
+    # another dtype, and every later step works on them in place or reduces
+    # them; the (block, D) test rows and column take two more rows of D
+    block = max(min(int(memory_budget) // (8 * (num_candidates + 2) * dim),
+                    num_test), 1)
+    gathered_buffer = np.empty((block, num_candidates, dim))
+    neighbors = np.zeros((num_test, k), dtype=np.intp)
+    dists = np.zeros((num_test, k))
+    for i0 in range(0, num_test, block):
+      X_block = X[i0:i0 + block].astype(np.float64)
+      cand = candidates[i0:i0 + block]
+      gathered = gathered_buffer[:cand.shape[0]]
+      if self.X_train.dtype == np.float64:
+        # mode='clip' writes straight into out, where 'raise' buffers
+        np.take(self.X_train, cand, axis=0, out=gathered, mode='clip')
+      else:
+        for j in range(num_candidates):
+          gathered[:, j] = self.X_train[cand[:, j]]
+      if self.metric == 'l1':
+        gathered -= X_block[:, np.newaxis, :]
+        cand_d = np.sum(np.abs(gathered, out=gathered), axis=2)
+      else:
+        cand_d = np.einsum('nd,ncd->nc', X_block, gathered)
+        test_sq = _sq_norms(X_block).reshape(-1, 1)
+        train_sq = self.train_sq_norms[cand]
+        if train_sq.dtype != np.float64:
+          # norms cached in a narrower dtype are not exact enough
+          train_sq = np.einsum('ncd,ncd->nc', gathered, gathered)
+        cand_d = _finish_tile(cand_d, test_sq, train_sq, self.metric)
+      order = np.argsort(cand_d, axis=1)[:, :k]
+      neighbors[i0:i0 + block] = np.take_along_axis(cand, order, axis=1)
+      best_d = np.take_along_axis(cand_d, order, axis=1)
+      dists[i0:i0 + block] = _final_distances(best_d, self.metric)
+    return neighbors, dists
+
+  def _vote(self, neighbors):
+    """
+    Majority vote over the labels of the given training points, breaking ties
+    by choosing the smaller label.
+
+    Inputs:
+    - neighbors: A numpy array of shape (num_test, k) of indices into
+      self.y_train.
+
+    Returns:
+    - y: A numpy array of shape (num_test,) containing predicted labels.
+    """
+    return self.classes[_vote_codes(self.y_codes[neighbors],
+                                    len(self.classes))]
+
   def predict_labels(self, dists, k=1):
     """
     Given a matrix of distances between test points and training points,
@@ -165,34 +623,595 @@ class KNearestNeighbor(object):
     - y: A numpy array of shape (num_test,) containing predicted labels for the
       test data, where y[i] is the predicted label for the test point X[i].  
     """
-    num_test = dists.shape[0]
-    y_pred = np.zeros(num_test)
-    for i in range(num_test):
-      # A list of length k storing the labels of the k nearest neighbors to
-      # the ith test point.
-      closest_y = []
-      #########################################################################
-      # TODO:                                                                 #
-      # Use the distance matrix to find the k nearest neighbors of the ith    #
-      # testing point, and use self.y_train to find the labels of these       #
-      # neighbors. Store these labels in closest_y.                           #
-      # Hint: Look up the function numpy.argsort.                             #
-      #########################################################################
-      index_of_k_closest_images = np.argsort( (dists[i,:]) )[:k]
-      closest_y = self.y_train[ index_of_k_closest_images ]
-      #########################################################################
-      # TODO:                                                                 #
-      # Now that you have found the labels of the k nearest neighbors, you    #
-      # need to find the most common label in the list closest_y of labels.   #
-      # Store this label in y_pred[i]. Break ties by choosing the smaller     #
-      # label.                                                                #
-      #########################################################################
-      #we can also use Counter from collections
-      label, label_count = np.unique (closest_y, return_counts = True)
-      y_pred[i] = label[np.argmax(label_count)]
-      #########################################################################
-      #                           END OF YOUR CODE                            # 
-      #########################################################################
+    num_train = dists.shape[1]
+    k = min(k, num_train)
+    #########################################################################
+    # TODO:                                                                 #
+    # Use the distance matrix to find the k nearest neighbors of the ith    #
+    # testing point, and use self.y_train to find the labels of these       #
+    # neighbors. Store these labels in closest_y.                           #
+    # Hint: Look up the function numpy.argsort.                             #
+    #########################################################################
+    # only the set of the k closest points matters for the vote, so a
+    # partition of every row at once is enough; no full sort is needed
+    if k < num_train:
+      closest = np.argpartition(dists, k - 1, axis=1)[:, :k]
+    else:
+      closest = np.broadcast_to(np.arange(num_train), dists.shape)
+    #########################################################################
+    # TODO:                                                                 #
+    # Now that you have found the labels of the k nearest neighbors, you    #
+    # need to find the most common label in the list closest_y of labels.   #
+    # Store this label in y_pred[i]. Break ties by choosing the smaller     #
+    # label.                                                                #
+    #########################################################################
+    y_pred = self._vote(closest)
+    #########################################################################
+    #                           END OF YOUR CODE                            # 
+    #########################################################################
 
     return y_pred
 
+  def predict_multi_k(self, dists, ks):
+    """
+    Predict labels for several values of k from a single partial sort, e.g.
+    for choosing k by cross-validation.
+
+    Every row of dists is partitioned once around max(ks) and only that prefix
+    is sorted; the votes for each k are then accumulated incrementally.
+
+    Inputs:
+    - dists: A numpy array of shape (num_test, num_train) as in predict_labels.
+    - ks: A sequence of positive integers.
+
+    Returns:
+    - A dictionary mapping each k in ks to a numpy array of shape (num_test,)
+      of predicted labels, identical to predict_labels(dists, k=k).
+    """
+    num_train = dists.shape[1]
+    k_max = min(max(ks), num_train)
+    if k_max < num_train:
+      closest = np.argpartition(dists, k_max - 1, axis=1)[:, :k_max]
+    else:
+      closest = np.broadcast_to(np.arange(num_train), dists.shape)
+    order = np.argsort(np.take_along_axis(dists, closest, axis=1), axis=1)
+    closest = np.take_along_axis(closest, order, axis=1)
+    return self._vote_multi_k(closest, ks)
+
+  def _vote_multi_k(self, neighbors, ks):
+    """
+    Majority votes for several values of k.
+
+    Inputs:
+    - neighbors: A numpy array of shape (num_test, k_max) of indices into
+      self.y_train, sorted from closest to farthest.
+    - ks: A sequence of positive integers; values above k_max are clipped.
+
+    Returns:
+    - A dictionary mapping each k in ks to predicted labels, as in _vote.
+    """
+    num_test, k_max = neighbors.shape
+    num_classes = len(self.classes)
+    codes = self.y_codes[neighbors]
+    offsets = (np.arange(num_test) * num_classes).reshape(-1, 1)
+    counts = np.zeros(num_test * num_classes, dtype=np.intp)
+    y_preds = {}
+    counted = 0
+    for k in sorted(set(ks)):
+      upto = min(k, k_max)
+      if upto > counted:
+        # add the votes of neighbors counted ... upto - 1
+        counts += np.bincount((codes[:, counted:upto] + offsets).ravel(),
+                              minlength=num_test * num_classes)
+        counted = upto
+      best = np.argmax(counts.reshape(num_test, num_classes), axis=1)
+      y_preds[k] = self.classes[best]
+    return y_preds
+
+
+def _dump_state(obj, path, prefix, saved):
+  """
+  Save the array attributes of obj, recursing into objects of this package,
+  as .npy files under path and return a picklable description of obj that
+  refers to them by file name. saved maps the id of every array written so
+  far to its file name so that shared arrays are written once.
+  """
+  state = {}
+  for name, value in vars(obj).items():
+    if name.startswith('_'):
+      continue
+    if isinstance(value, np.ndarray):
+      if id(value) not in saved:
+        saved[id(value)] = prefix + name + '.npy'
+        np.save(os.path.join(path, saved[id(value)]), value)
+      value = _SavedArray(saved[id(value)])
+    elif type(value).__module__.startswith('cs231n'):
+      value = _dump_state(value, path, prefix + name + '.', saved)
+    state[name] = value
+  return _SavedObject(type(obj), state)
+
+
+def _load_state(description, path, mmap_mode, loaded):
+  """ Inverse of _dump_state. """
+  cls, state = description
+  obj = cls.__new__(cls)
+  for name, value in state.items():
+    if isinstance(value, _SavedArray):
+      if value.filename not in loaded:
+        loaded[value.filename] = np.load(os.path.join(path, value.filename),
+                                         mmap_mode=mmap_mode)
+      value = loaded[value.filename]
+    elif isinstance(value, _SavedObject):
+      value = _load_state(value, path, mmap_mode, loaded)
+    setattr(obj, name, value)
+  return obj
+
+
+# Placeholders used by save in model.pkl for an array attribute written to
+# its own file, and for an object whose attributes were saved recursively.
+_SavedArray = namedtuple('_SavedArray', ['filename'])
+_SavedObject = namedtuple('_SavedObject', ['cls', 'state'])
+
+
+# State of a worker process of KNearestNeighbor._predict_parallel
+_worker = {}
+
+
+def _init_predict_worker(model_spec, x_spec, kwargs):
+  _worker['model'], _worker['blocks'] = attach_attributes(model_spec)
+  x_block, _worker['X'] = attach_array(x_spec)
+  _worker['blocks'].append(x_block)
+  _worker['kwargs'] = kwargs
+
+
+def _predict_worker_slice(bounds):
+  start, stop = bounds
+  return _worker['model'].predict(_worker['X'][start:stop], **_worker['kwargs'])
+
+
+def ann_recall_report(X_train, X_test, configs, k=10, verbose=False,
+                      shifts=(0.0, RAW_PIXEL_SHIFT)):
+  """
+  Measure how an approximate search index trades recall for speed, to pick
+  settings that meet a latency target.
+
+  Every configuration is also run on the data translated by each of shifts.
+  L2 neighbors do not change under a translation, so an index should give
+  the same recall and speed on centered data and on raw pixels, all around
+  RAW_PIXEL_SHIFT; one that does not is caught by the shifted rows.
+
+  Inputs:
+  - X_train: A numpy array of shape (num_train, D) of training points.
+  - X_test: A numpy array of shape (num_test, D) of query points.
+  - configs: A list of dictionaries of KNearestNeighbor keyword arguments,
+    e.g. {'index': 'lsh', 'num_tables': 8, 'hash_size': 12, 'num_probes': 2}.
+  - k: Number of neighbors to retrieve.
+  - verbose: If true, print one line per configuration and shift.
+  - shifts: Constants added to every coordinate of X_train and X_test.
+
+  Returns:
+  A list with one dictionary per configuration and shift with the keys:
+  - 'config': the configuration.
+  - 'shift': the constant added to the data.
+  - 'recall': mean fraction of the exact k nearest neighbors that were found.
+  - 'qps': queries answered per second.
+  - 'build_time': seconds spent building the index.
+  - 'candidates': mean number of candidates re-ranked per query, or None if
+    the index does not report it.
+  """
+  exact = KNearestNeighbor()
+  exact.train(X_train, np.zeros(X_train.shape[0], dtype=np.int64))
+  true_neighbors, _ = exact.compute_neighbors_tiled(X_test, k=k)
+
+  results = []
+  for shift in shifts:
+    if shift:
+      train, test = X_train + shift, X_test + shift
+    else:
+      train, test = X_train, X_test
+    for config in configs:
+      knn = KNearestNeighbor(**config)
+      tic = time.time()
+      knn.train(train, exact.y_train)
+      build_time = time.time() - tic
+      tic = time.time()
+      neighbors, _ = knn.index.query(test, k=k)
+      query_time = time.time() - tic
+
+      found = (neighbors[:, :, None] == true_neighbors[:, None, :]).any(axis=2)
+      candidates = getattr(knn.index, 'last_num_candidates', None)
+      if candidates is not None:
+        candidates = float(candidates) / X_test.shape[0]
+      results.append({
+        'config': config,
+        'shift': shift,
+        'recall': found.mean(),
+        'qps': X_test.shape[0] / max(query_time, 1e-12),
+        'build_time': build_time,
+        'candidates': candidates,
+      })
+      if verbose:
+        print('%s shift %g recall@%d %f qps %.1f build %.2fs' % (
+          config, shift, k, results[-1]['recall'], results[-1]['qps'],
+          build_time))
+  return results
+
+
+def cross_validate_k(X, y, ks, num_folds=5, metric='l2',
+                     memory_budget=DEFAULT_MEMORY_BUDGET):
+  """
+  k-fold cross-validation of the number of neighbors k with a single
+  distance pass.
+
+  X is split into num_folds consecutive folds, as np.array_split does. Each
+  point is classified using the points of the other folds as training data.
+  Instead of retraining and recomputing distances for every (fold, k) pair,
+  the distances between all pairs of points are computed once, tile by tile
+  within memory_budget: pairs in the same fold are masked out, the max(ks)
+  nearest neighbors of each point are kept in order, and every k is voted
+  from that single partial sort.
+
+  Inputs:
+  - X: A numpy array of shape (N, D) of training data.
+  - y: A numpy array of shape (N,) of labels.
+  - ks: A sequence of positive integers, the values of k to evaluate.
+  - num_folds: Number of folds.
+  - metric: One of METRICS.
+  - memory_budget: Approximate number of bytes of scratch space to use.
+
+  Returns:
+  - A dictionary mapping each k in ks to a list of num_folds accuracies,
+    where entry i is the accuracy on fold i of a classifier trained on the
+    other folds, as predict would give (ties between equal distances
+    aside).
+  """
+  num_train = X.shape[0]
+  fold_sizes = [len(fold) for fold in
+                np.array_split(np.arange(num_train), num_folds)]
+  folds = np.repeat(np.arange(num_folds), fold_sizes)
+  knn = KNearestNeighbor(metric=metric)
+  knn.train(X, y)
+
+  # a point can only have neighbors outside of its fold
+  k_max = min(max(ks), num_train - max(fold_sizes))
+  neighbors, _ = _top_k_tiled(X, knn.X_train, knn.train_sq_norms, k_max,
+                              memory_budget, metric, folds, folds)
+  y_preds = knn._vote_multi_k(neighbors, ks)
+
+  k_to_accuracies = {}
+  for k in ks:
+    correct = y_preds[k] == y
+    k_to_accuracies[k] = [float(np.mean(correct[folds == fold]))
+                          for fold in range(num_folds)]
+  return k_to_accuracies
+
+
+def reduction_report(X_train, y_train, X_val, y_val, configs, k=1,
+                     metric='l2', verbose=False):
+  """
+  Compare the accuracy and speed of classifiers built on reduced training
+  sets with those of the full training set, to decide whether a reduced set
+  is good enough to serve.
+
+  Inputs:
+  - X_train, y_train: Training data and labels.
+  - X_val, y_val: Validation data and labels.
+  - configs: A list of dictionaries of KNearestNeighbor.reduce keyword
+    arguments, e.g. {'method': 'kmeans', 'prototypes_per_class': 50}.
+  - k: Number of neighbors used for prediction.
+  - metric: One of METRICS.
+  - verbose: If true, print one line per configuration.
+
+  Returns:
+  A list of dictionaries, the first one for the full training set and then
+  one per configuration, with the keys:
+  - 'config': the configuration, or None for the full training set.
+  - 'size': number of training points kept.
+  - 'fraction': size as a fraction of the full training set.
+  - 'accuracy': accuracy on the validation set.
+  - 'qps': validation points predicted per second.
+  - 'reduce_time': seconds spent reducing the training set.
+  """
+  full = KNearestNeighbor(metric=metric)
+  full.train(X_train, y_train)
+  num_train = X_train.shape[0]
+
+  results = []
+  for config in [None] + list(configs):
+    tic = time.time()
+    knn = full if config is None else full.reduce(**config)
+    reduce_time = time.time() - tic
+    tic = time.time()
+    y_pred = knn.predict(X_val, k=k, memory_budget=DEFAULT_MEMORY_BUDGET)
+    predict_time = time.time() - tic
+    size = knn.X_train.shape[0]
+    results.append({
+      'config': config,
+      'size': size,
+      'fraction': float(size) / num_train,
+      'accuracy': np.mean(y_pred == y_val),
+      'qps': X_val.shape[0] / max(predict_time, 1e-12),
+      'reduce_time': reduce_time,
+    })
+    if verbose:
+      print('%s size %d (%.3f) accuracy %f qps %.1f reduce %.2fs' % (
+        'full' if config is None else config, size, results[-1]['fraction'],
+        results[-1]['accuracy'], results[-1]['qps'], reduce_time))
+  return results
+
+
+def _vote_codes(closest_codes, num_classes):
+  """
+  Vectorized majority vote.
+
+  Inputs:
+  - closest_codes: Integer array of shape (num_test, k) with values in
+    0 ... num_classes - 1.
+  - num_classes: Number of distinct codes.
+
+  Returns:
+  - An integer array of shape (num_test,) with the most frequent code of each
+    row; ties go to the smaller code.
+  """
+  num_test = closest_codes.shape[0]
+  # shift row i into its own range of bins so one bincount covers every row
+  offsets = (np.arange(num_test) * num_classes).reshape(-1, 1)
+  counts = np.bincount((closest_codes + offsets).ravel(),
+                       minlength=num_test * num_classes)
+  # argmax returns the first maximum, i.e. the smallest code
+  return np.argmax(counts.reshape(num_test, num_classes), axis=1)
+
+
+def _distance_tile(X_block, test_sq, X_train, train_sq, metric):
+  """
+  Compute one tile of the tiled engine.
+
+  Inputs:
+  - X_block: Array of shape (b, D) of test points.
+  - test_sq: Array of shape (b, 1) of their squared norms.
+  - X_train: Array of shape (n, D) of training points.
+  - train_sq: Array of shape (n,) of their squared norms.
+  - metric: One of METRICS.
+
+  Returns an array of shape (b, n) that orders the pairs like the metric
+  does: squared distances for l2, distances for l1 and cosine. It has the
+  dtype of X_train, except for l1 which is always float64, and for integer
+  data, where l2 tiles hold exact int64 squared distances.
+  """
+  if metric == 'l1':
+    # scipy's compiled kernel avoids the (b, n, D) temporary of broadcasting
+    return cdist(X_block, X_train, 'cityblock')
+  tile = _dot_tile(X_block, X_train)
+  if metric == 'cosine' and tile.dtype == np.int64:
+    tile = tile.astype(np.float64)
+  return _finish_tile(tile, test_sq, train_sq, metric)
+
+
+def _is_integer(X):
+  return np.issubdtype(X.dtype, np.integer)
+
+
+def _sq_norms(X, dtype=None):
+  """
+  Squared norms of the rows of X: exact int64 values for integer X, else
+  accumulated in float64 and returned in dtype (by default the dtype of X).
+  """
+  if _is_integer(X):
+    work_dtype = dtype = np.int64
+  else:
+    work_dtype = np.float64
+    if dtype is None:
+      dtype = X.dtype
+  # convert a few rows at a time so that no int64 or float64 copy of X is made
+  norms = np.zeros(X.shape[0], dtype=dtype)
+  block = max(2 ** 20 // max(X.shape[1], 1), 1)
+  for i0 in range(0, X.shape[0], block):
+    rows = X[i0:i0 + block].astype(work_dtype)
+    norms[i0:i0 + block] = np.einsum('ij,ij->i', rows, rows)
+  return norms
+
+
+def _as_train_dtype(X_block, X_train):
+  """
+  Convert test points to the dtype of floating point training data, so that
+  the products of a tile run in that dtype instead of being upcast.
+  """
+  if _is_integer(X_train):
+    return X_block
+  return X_block.astype(X_train.dtype, copy=False)
+
+
+def _dot_tile(X_block, X_train):
+  """
+  Compute the tile of dot products X_block.dot(X_train.T).
+
+  For integer data of up to 16 bits the blocks are converted to float64 so
+  the product runs in BLAS (numpy's integer matrix product does not): every
+  partial sum is an integer below 2 ** 53 and therefore exact, and the tile
+  is returned as int64. Wider integers use the exact but slow int64 product.
+  """
+  if not (_is_integer(X_block) and _is_integer(X_train)):
+    return np.dot(X_block, X_train.T)
+  if X_block.dtype.itemsize <= 2 and X_train.dtype.itemsize <= 2:
+    tile = np.dot(X_block.astype(np.float64), X_train.astype(np.float64).T)
+    return tile.astype(np.int64)
+  return np.dot(X_block.astype(np.int64), X_train.astype(np.int64).T)
+
+
+def _finish_tile(tile, test_sq, train_sq, metric):
+  """
+  Turn a tile of dot products into l2 or cosine tile values, in place.
+
+  Inputs:
+  - tile: Array of shape (b, n) of dot products between test and training
+    points.
+  - test_sq: Array of shape (b, 1) of squared test norms.
+  - train_sq: Array broadcastable to (b, n) of squared training norms.
+  - metric: 'l2' or 'cosine'.
+
+  Returns tile, holding squared distances for l2 and distances for cosine.
+  """
+  if metric == 'l2':
+    tile *= -2
+    tile += test_sq
+    tile += train_sq
+    return tile
+  # dividing by the norms turns the dot products into cosine similarities;
+  # a norm of zero gives a similarity of zero instead of nan
+  with np.errstate(divide='ignore'):
+    tile *= np.where(test_sq > 0, 1 / np.sqrt(test_sq), 0).astype(tile.dtype)
+    tile *= np.where(train_sq > 0, 1 / np.sqrt(train_sq), 0).astype(tile.dtype)
+  np.subtract(1, tile, out=tile)
+  return tile
+
+
+def _final_distances(values, metric):
+  """
+  Convert tile values to distances under metric.
+  """
+  if metric == 'l2':
+    # rounding can leave tiny negative squared distances
+    return np.sqrt(np.maximum(values, 0))
+  return values
+
+
+def _distances_tiled(X, X_train, train_sq, metric, memory_budget):
+  """
+  Build the full (num_test, num_train) distance matrix under metric, one
+  tile of the tiled engine at a time.
+  """
+  num_test = X.shape[0]
+  num_train = X_train.shape[0]
+  test_block, train_block = _tile_shape(
+    num_test, num_train, 1, memory_budget, X_train.shape[1],
+    _conversion_itemsize(X_train, metric))
+  floating = not (_is_integer(X_train) or metric == 'l1')
+  dists = np.zeros((num_test, num_train),
+                   dtype=X_train.dtype if floating else np.float64)
+  for i0 in range(0, num_test, test_block):
+    X_block = _as_train_dtype(X[i0:i0 + test_block], X_train)
+    test_sq = _sq_norms(X_block).reshape(-1, 1)
+    for j0 in range(0, num_train, train_block):
+      j1 = min(j0 + train_block, num_train)
+      tile = _distance_tile(X_block, test_sq, X_train[j0:j1],
+                            train_sq[j0:j1], metric)
+      dists[i0:i0 + test_block, j0:j1] = _final_distances(tile, metric)
+  return dists
+
+
+def _top_k_tiled(X, X_train, train_sq, k, memory_budget, metric='l2',
+                 test_groups=None, train_groups=None):
+  """
+  Tiled top-k search behind KNearestNeighbor.compute_neighbors_tiled.
+
+  Inputs:
+  - X: Array of shape (num_test, D) of test points.
+  - X_train: Array of shape (num_train, D) of training points.
+  - train_sq: Array of shape (num_train,) of squared training norms.
+  - k: Number of neighbors to find; at most num_train.
+  - memory_budget: Approximate number of bytes of scratch space to use.
+  - metric: One of METRICS.
+  - test_groups, train_groups: Optional integer arrays of shape (num_test,)
+    and (num_train,). If given, a training point is never a neighbor of a
+    test point of the same group, and k must leave enough points in the
+    other groups.
+
+  Returns a tuple (neighbors, dists) of arrays of shape (num_test, k), sorted
+  by increasing distance. dists has the dtype of X_train, or float64 for
+  integer X_train.
+  """
+  num_test = X.shape[0]
+  num_train = X_train.shape[0]
+  test_block, train_block = _tile_shape(
+    num_test, num_train, k, memory_budget, X_train.shape[1],
+    _conversion_itemsize(X_train, metric))
+
+  neighbors = np.zeros((num_test, k), dtype=np.intp)
+  dists = np.zeros((num_test, k), dtype=np.float64 if _is_integer(X_train)
+                   else X_train.dtype)
+  for i0 in range(0, num_test, test_block):
+    X_block = _as_train_dtype(X[i0:i0 + test_block], X_train)
+    test_sq = _sq_norms(X_block, dists.dtype).reshape(-1, 1)
+    best_d = np.zeros((X_block.shape[0], 0), dtype=X_train.dtype)
+    best_i = np.zeros((X_block.shape[0], 0), dtype=np.intp)
+    for j0 in range(0, num_train, train_block):
+      j1 = min(j0 + train_block, num_train)
+      tile = _distance_tile(X_block, test_sq, X_train[j0:j1],
+                            train_sq[j0:j1], metric)
+      if test_groups is not None:
+        same = test_groups[i0:i0 + test_block].reshape(-1, 1) == \
+          train_groups[j0:j1]
+        tile[same] = np.iinfo(tile.dtype).max if _is_integer(tile) else np.inf
+      best_d, best_i = _merge_top_k(best_d, best_i, tile, j0, k)
+
+    order = np.argsort(best_d, axis=1)
+    best_d = np.take_along_axis(best_d, order, axis=1)
+    neighbors[i0:i0 + test_block] = np.take_along_axis(best_i, order, axis=1)
+    dists[i0:i0 + test_block] = _final_distances(best_d, metric)
+
+  return neighbors, dists
+
+
+def _tile_shape(num_test, num_train, k, memory_budget, dim=0,
+                convert_itemsize=0):
+  """
+  Pick (test_block, train_block) so that one tile of the tiled distance
+  engine fits in memory_budget bytes. A tile needs roughly three arrays of
+  test_block * (train_block + k) 8-byte elements: the distance tile, the merge
+  candidates and the partition indices. If the kernels convert the test and
+  training blocks (see _conversion_itemsize), the converted copies of
+  (test_block + train_block) rows of dim elements of convert_itemsize bytes
+  count against the budget too.
+  """
+  budget = int(memory_budget)
+  row = dim * convert_itemsize
+  test_block = max(min(num_test, int(np.sqrt(max(budget // 24, 1)))), 1)
+  train_block = (budget - row * test_block) // (24 * test_block + row) - k
+  train_block = max(min(num_train, train_block), 1)
+  if train_block == num_train:
+    # the whole training set fits in one tile: use taller tiles instead
+    test_block = (budget - row * num_train) // (24 * (num_train + k) + row)
+    test_block = max(min(num_test, test_block), 1)
+  return test_block, train_block
+
+
+def _conversion_itemsize(X_train, metric):
+  """
+  Bytes per element of the copies the tile kernels make of the blocks they
+  are given: cdist converts every block that is not float64 to float64, and
+  _dot_tile converts integer blocks to float64 or int64.
+  """
+  if metric == 'l1':
+    return 0 if X_train.dtype == np.float64 else 8
+  return 8 if _is_integer(X_train) else 0
+
+
+def _merge_top_k(best_d, best_i, tile, offset, k):
+  """
+  Merge a tile of distances into a running top-k.
+
+  Inputs:
+  - best_d: Array of shape (B, kk) with the kk <= k best distances so far.
+  - best_i: Array of shape (B, kk) with the matching training indices.
+  - tile: Array of shape (B, T) of distances to training points
+    offset, ..., offset + T - 1.
+  - offset: Training index of the first column of tile.
+  - k: Number of neighbors to keep.
+
+  Returns a tuple (best_d, best_i) of arrays of shape (B, min(k, kk + T)),
+  in no particular order within a row.
+  """
+  kk = best_d.shape[1]
+  cand_d = np.concatenate((best_d, tile), axis=1)
+  keep = min(k, cand_d.shape[1])
+  if keep == cand_d.shape[1]:
+    part = np.broadcast_to(np.arange(keep), cand_d.shape)
+  else:
+    part = np.argpartition(cand_d, keep - 1, axis=1)[:, :keep]
+  new_d = np.take_along_axis(cand_d, part, axis=1)
+  if kk == 0:
+    new_i = part + offset
+  else:
+    from_best = np.take_along_axis(best_i, np.minimum(part, kk - 1), axis=1)
+    new_i = np.where(part < kk, from_best, part - kk + offset)
+  return new_d, new_i
@@ -0,0 +1,962 @@
+import warnings
+
+import numpy as np
+
+# Points added after an index is built are kept in a pending part that is
+# searched separately; it is folded into the index once it holds more than
+# this fraction of the indexed points, which keeps additions amortized
+# linear in the number of points added.
+PENDING_FRACTION = 0.25
+
+# Largest number of (query, leaf) bounds a tree search holds per batch.
+BOUND_ELEMENTS = 2 ** 22
+
+# Number of leaves closest to every query that a tree search scans first,
+# and number of queries whose leaves are gathered at a time.
+FIRST_LEAVES = 3
+GATHER_QUERIES = 256
+
+
+def append_rows(buffer, current, rows):
+  """
+  Append rows to an array kept at the front of a larger buffer, doubling the
+  buffer whenever it is full so that appends cost amortized O(len(rows)).
+
+  Inputs:
+  - buffer: The buffer whose front holds current, or None if current is not
+    held by a buffer yet (e.g. it was passed in by the user or loaded from
+    disk); current is then copied into a new buffer.
+  - current: The array of the rows so far, current == buffer[:len(current)].
+  - rows: The rows to append.
+
+  Returns a tuple of:
+  - buffer: The buffer, possibly reallocated.
+  - current: A view of the front of buffer holding current and rows.
+  """
+  used = current.shape[0]
+  needed = used + rows.shape[0]
+  if buffer is None or needed > buffer.shape[0]:
+    capacity = max(needed, 2 * used, 16)
+    new_buffer = np.empty((capacity,) + current.shape[1:], dtype=current.dtype)
+    new_buffer[:used] = current
+    buffer = new_buffer
+  buffer[used:needed] = rows
+  return buffer, buffer[:needed]
+
+
+class _SpaceTree(object):
+  """
+  Common code of the space-partitioning indexes used by KNearestNeighbor.
+
+  The tree is built by splitting nodes at the median of their widest
+  dimension until they hold at most leaf_size points, and the training
+  points are reordered so that every leaf is a contiguous slice of
+  self.data: leaf j owns self.data[leaf_start[j]:leaf_end[j]]. Subclasses
+  only define the bounding volume of a leaf and the lower bound on the
+  distance from a query to it.
+
+  A search computes the bound from every query of a batch to every leaf at
+  once, scans the few closest leaves of every query to get a tight k-th
+  distance, and then scans, one leaf at a time with a matrix product, the
+  queries whose bound to that leaf is still below their k-th distance. This
+  costs a fixed number of numpy calls per leaf and batch rather than per
+  node visited, but trees only prune well at low dimension: past max_dim
+  dimensions most leaves survive and brute-force search is faster, so build
+  warns.
+
+  Points given to add after the tree was built are searched by brute force
+  until there are enough of them to rebuild the tree.
+  """
+
+  # Dimension past which brute-force search is faster; set by subclasses.
+  max_dim = None
+
+  def __init__(self, leaf_size=40):
+    if leaf_size < 1:
+      raise ValueError('leaf_size must be positive, got %d' % leaf_size)
+    self.leaf_size = leaf_size
+
+  def build(self, X):
+    """
+    Build the tree over the training points.
+
+    Inputs:
+    - X: A numpy array of shape (num_train, D) of training points; a
+      reference is kept for add.
+    """
+    if X.shape[1] > self.max_dim:
+      warnings.warn('%s on %d dimensions: it is slower than brute-force '
+                    'search past %d dimensions; reduce the dimension with '
+                    'PCA first, or use index=None or an approximate index' % (
+                      type(self).__name__, X.shape[1], self.max_dim))
+    self.source = X
+    X = np.asarray(X, dtype=np.float64)
+    num_train = X.shape[0]
+    order = np.arange(num_train)
+    nodes = [(0, num_train)]
+    leaves = []
+
+    # split nodes breadth first at the median of their widest dimension
+    while nodes:
+      start, end = nodes.pop(0)
+      if end - start <= self.leaf_size:
+        leaves.append((start, end))
+        continue
+      points = X[order[start:end]]
+      dim = np.argmax(points.max(axis=0) - points.min(axis=0))
+      mid = (end - start) // 2
+      split = np.argpartition(points[:, dim], mid)
+      order[start:end] = order[start:end][split]
+      nodes += [(start, start + mid), (start + mid, end)]
+
+    leaves.sort()
+    self.order = order
+    self.data = X[order]
+    self.sq_norms = np.sum(self.data ** 2, axis=1)
+    self.leaf_start = np.array([leaf[0] for leaf in leaves])
+    self.leaf_end = np.array([leaf[1] for leaf in leaves])
+    self.num_indexed = num_train
+    self._build_bounds()
+
+  def add(self, X, data):
+    """
+    Add training points.
+
+    Inputs:
+    - X: A numpy array of shape (num_new, D) of the new points.
+    - data: The whole training set after the addition, of which X are the
+      last rows; a reference is kept.
+    """
+    self.source = data
+    if data.shape[0] - self.num_indexed > PENDING_FRACTION * self.num_indexed:
+      self.build(data)
+
+  def query(self, X, k=1, batch_size=4096):
+    """
+    Exact k-nearest-neighbor search.
+
+    Queries are answered batch_size at a time, fewer if the bounds from a
+    batch to every leaf would hold more than BOUND_ELEMENTS entries.
+
+    Inputs:
+    - X: A numpy array of shape (num_test, D) of query points.
+    - k: The number of neighbors to find.
+    - batch_size: The number of queries to search together.
+
+    Returns a tuple of:
+    - neighbors: A numpy array of shape (num_test, k) of indices into the
+      training points, ordered from closest to farthest.
+    - dists: A numpy array of shape (num_test, k) of Euclidean distances.
+    """
+    X = np.asarray(X, dtype=np.float64)
+    num_test = X.shape[0]
+    k = min(k, self.source.shape[0])
+    batch_size = max(min(batch_size,
+                         BOUND_ELEMENTS // len(self.leaf_start)), 1)
+    pending = np.asarray(self.source[self.num_indexed:], dtype=np.float64)
+    pending_norms = np.sum(pending ** 2, axis=1)
+    neighbors = np.zeros((num_test, k), dtype=np.intp)
+    dists = np.zeros((num_test, k))
+    for i0 in range(0, num_test, batch_size):
+      Q = X[i0:i0 + batch_size]
+      best_d, best_i = self._query_batch(Q, k)
+      # positions into self.data become training indices; pending points
+      # are merged in with indices past num_indexed
+      best_i = self.order[best_i]
+      everyone = np.arange(Q.shape[0])
+      q_norms = np.sum(Q ** 2, axis=1)
+      kth = best_d.max(axis=1)
+      for p0 in range(0, pending.shape[0], self.leaf_size):
+        p1 = p0 + self.leaf_size
+        _merge_points(Q, q_norms, everyone, pending[p0:p1],
+                      pending_norms[p0:p1],
+                      np.arange(p0, p0 + pending[p0:p1].shape[0]) +
+                      self.num_indexed, best_d, best_i, kth)
+      np.maximum(best_d, 0, out=best_d)
+      order = np.argsort(best_d, axis=1)
+      neighbors[i0:i0 + batch_size] = np.take_along_axis(best_i, order, axis=1)
+      dists[i0:i0 + batch_size] = np.sqrt(
+        np.take_along_axis(best_d, order, axis=1))
+    return neighbors, dists
+
+  def _query_batch(self, Q, k):
+    """
+    Search the tree for a batch of queries. Returns squared distances and
+    positions into self.data, in no particular order.
+    """
+    num_queries = Q.shape[0]
+    num_leaves = len(self.leaf_start)
+    q_norms = np.sum(Q ** 2, axis=1)
+    best_d = np.full((num_queries, k), np.inf)
+    best_i = np.zeros((num_queries, k), dtype=np.intp)
+    kth = np.full(num_queries, np.inf)
+    proximity, bound = self._leaf_bounds(Q, q_norms)
+
+    # scan the closest leaves of every query, in one gather for the whole
+    # batch, so that its k-th distance is tight before any pruning
+    num_first = min(FIRST_LEAVES, num_leaves)
+    first = np.argpartition(proximity, num_first - 1, axis=1)[:, :num_first]
+    rows = np.arange(self.leaf_size)
+    for j0 in range(0, num_queries, GATHER_QUERIES):
+      q = np.arange(j0, min(j0 + GATHER_QUERIES, num_queries))
+      start = self.leaf_start[first[q]][:, :, None]
+      positions = start + rows
+      valid = positions < self.leaf_end[first[q]][:, :, None]
+      positions = np.where(valid, positions, 0).reshape(q.size, -1)
+      cand_d = (q_norms[q, None] + self.sq_norms[positions] -
+                2 * np.einsum('qd,qpd->qp', Q[q], self.data[positions]))
+      cand_d[~valid.reshape(q.size, -1)] = np.inf
+      _merge_candidates(q, cand_d, positions, best_d, best_i, kth)
+
+    # then every other leaf that may still hold a closer point, one leaf
+    # at a time for all the queries that need it
+    bound[np.arange(num_queries)[:, None], first] = np.inf
+    needed = bound < kth[:, None]
+    for leaf in np.nonzero(needed.any(axis=0))[0]:
+      q = np.nonzero(needed[:, leaf])[0]
+      q = q[bound[q, leaf] < kth[q]]
+      start, end = self.leaf_start[leaf], self.leaf_end[leaf]
+      _merge_points(Q, q_norms, q, self.data[start:end],
+                    self.sq_norms[start:end], np.arange(start, end), best_d,
+                    best_i, kth)
+    return best_d, best_i
+
+  def _build_bounds(self):
+    raise NotImplementedError
+
+  def _leaf_bounds(self, Q, q_norms):
+    """
+    Returns a tuple of:
+    - proximity: Array of shape (num_queries, num_leaves); smaller means
+      closer, used to pick the leaves scanned first.
+    - bound: Array of the same shape of squared lower bounds on the distance
+      from every query to the points of every leaf.
+    """
+    raise NotImplementedError
+
+
+def _merge_points(Q, q_norms, q, points, sq_norms, ids, best_d, best_i, kth):
+  """
+  Merge points into the running top-k of the queries Q[q], in place.
+
+  Inputs:
+  - Q: Array of shape (num_queries, D) of queries.
+  - q_norms: Array of shape (num_queries,) of the squared norms of Q.
+  - q: Integer array of the queries to update.
+  - points: Array of shape (P, D) of points.
+  - sq_norms: Array of shape (P,) of the squared norms of points.
+  - ids: Integer array of shape (P,) of the ids stored for points.
+  - best_d, best_i: Arrays of shape (num_queries, k) of squared distances
+    and ids of the best points so far, padded with inf if fewer are known.
+  - kth: Array of shape (num_queries,) of the largest entry of every row of
+    best_d.
+  """
+  if q.size == 0 or points.shape[0] == 0:
+    return
+  cand_d = q_norms[q, None] - 2 * Q[q].dot(points.T)
+  cand_d += sq_norms
+  _merge_candidates(q, cand_d, np.broadcast_to(ids, cand_d.shape), best_d,
+                    best_i, kth)
+
+
+def _merge_candidates(q, cand_d, cand_i, best_d, best_i, kth):
+  """
+  Merge candidates of shape (q.size, P), given by their squared distances
+  and ids, into the running top-k of the queries q, in place, as for
+  _merge_points.
+  """
+  # most candidates are farther than the current k-th neighbor; only the
+  # queries with a closer one need the partial sort
+  closer = (cand_d < kth[q, None]).any(axis=1)
+  if not closer.all():
+    q, cand_d, cand_i = q[closer], cand_d[closer], cand_i[closer]
+    if q.size == 0:
+      return
+  k = best_d.shape[1]
+  cand_d = np.concatenate((best_d[q], cand_d), axis=1)
+  cand_i = np.concatenate((best_i[q], cand_i), axis=1)
+  part = np.argpartition(cand_d, k - 1, axis=1)[:, :k]
+  best_d[q] = np.take_along_axis(cand_d, part, axis=1)
+  best_i[q] = np.take_along_axis(cand_i, part, axis=1)
+  kth[q] = best_d[q].max(axis=1)
+
+
+class BallTree(_SpaceTree):
+  """ Exact kNN index whose leaves are bounded by balls. """
+
+  max_dim = 64
+
+  def _build_bounds(self):
+    num_leaves = len(self.leaf_start)
+    self.centers = np.zeros((num_leaves, self.data.shape[1]))
+    self.radii = np.zeros(num_leaves)
+    for j in range(num_leaves):
+      points = self.data[self.leaf_start[j]:self.leaf_end[j]]
+      self.centers[j] = points.mean(axis=0)
+      self.radii[j] = np.sqrt(np.max(np.sum((points - self.centers[j]) ** 2,
+                                            axis=1)))
+    self.center_sq_norms = np.sum(self.centers ** 2, axis=1)
+
+  def _leaf_bounds(self, Q, q_norms):
+    center_dist = q_norms[:, None] - 2 * Q.dot(self.centers.T)
+    center_dist += self.center_sq_norms
+    np.maximum(center_dist, 0, out=center_dist)
+    np.sqrt(center_dist, out=center_dist)
+    # unlike the lower bound this still tells overlapping balls apart
+    proximity = center_dist - self.radii
+    return proximity, np.maximum(proximity, 0) ** 2
+
+
+class KDTree(_SpaceTree):
+  """ Exact kNN index whose leaves are bounded by axis-aligned boxes. """
+
+  max_dim = 16
+
+  def _build_bounds(self):
+    num_leaves = len(self.leaf_start)
+    self.lower = np.zeros((num_leaves, self.data.shape[1]))
+    self.upper = np.zeros((num_leaves, self.data.shape[1]))
+    for j in range(num_leaves):
+      points = self.data[self.leaf_start[j]:self.leaf_end[j]]
+      self.lower[j] = points.min(axis=0)
+      self.upper[j] = points.max(axis=0)
+
+  def _leaf_bounds(self, Q, q_norms):
+    # one dimension at a time, so no (num_queries, num_leaves, D) array
+    bound = np.zeros((Q.shape[0], self.lower.shape[0]))
+    for d in range(Q.shape[1]):
+      gap = np.maximum(self.lower[:, d] - Q[:, d, None], 0)
+      gap += np.maximum(Q[:, d, None] - self.upper[:, d], 0)
+      gap **= 2
+      bound += gap
+    return bound, bound.copy()
+
+
+class LSHIndex(object):
+  """
+  Approximate kNN index based on locality-sensitive hashing.
+
+  Every table hashes a point to hash_size integers: the side of a random
+  hyperplane through the training mean ('hyperplane' family, approximating
+  the angular distance around the mean) or the bucket of a random projection
+  of width bucket_width ('pstable' family, approximating L2 distance). Data
+  need not be centered first. Points sharing all hash values in a table land
+  in the same bucket. A query collects the training points in its bucket of
+  every table, plus num_probes neighboring buckets per table (multi-probe:
+  the buckets obtained by moving the hash values closest to a bucket boundary
+  by one), and re-ranks these candidates with exact L2 distances. Queries
+  with fewer than k candidates fall back to a scan of the whole training set.
+
+  The keys of points given to add are kept in a pending table, sorted at
+  query time, until there are enough of them to merge into the main tables.
+  """
+
+  def __init__(self, num_tables=8, hash_size=12, family='hyperplane',
+               bucket_width=None, num_probes=0, seed=0):
+    """
+    Inputs:
+    - num_tables: Number of hash tables; more tables raise recall and cost.
+    - hash_size: Number of hash functions per table; more functions make
+      buckets smaller, lowering recall and cost.
+    - family: 'hyperplane' or 'pstable'.
+    - bucket_width: Only for 'pstable': width of a bucket in the units of the
+      data. Defaults to the standard deviation of the projected training
+      points.
+    - num_probes: Number of extra buckets probed per table at query time.
+    - seed: Seed for the random projections.
+    """
+    if family not in ('hyperplane', 'pstable'):
+      raise ValueError('Unknown LSH family "%s"' % family)
+    self.num_tables = num_tables
+    self.hash_size = hash_size
+    self.family = family
+    self.bucket_width = bucket_width
+    self.num_probes = num_probes
+    self.seed = seed
+
+  def build(self, X):
+    """
+    Hash the training points into every table.
+
+    Inputs:
+    - X: A numpy array of shape (num_train, D) of training points; a
+      reference is kept for re-ranking.
+    """
+    rng = np.random.RandomState(self.seed)
+    dim = X.shape[1]
+    num_hashes = self.num_tables * self.hash_size
+    self.data = X
+    self.sq_norms = np.sum(X.astype(np.float64) ** 2, axis=1)
+    self.projections = rng.randn(dim, num_hashes)
+    # projections are taken relative to the training mean: hyperplanes
+    # through the origin would leave most bits equal on data far from it,
+    # such as raw pixels
+    mean = np.mean(X, axis=0, dtype=np.float64)
+    if self.family == 'hyperplane':
+      self.offsets = -mean.dot(self.projections)
+      self.width = 1.0
+      # the key of a table is the binary number formed by its bits
+      self.multipliers = 2 ** np.arange(self.hash_size, dtype=np.int64)
+    else:
+      if self.bucket_width is None:
+        self.width = float(np.mean(np.std(X.dot(self.projections), axis=0)))
+      else:
+        self.width = float(self.bucket_width)
+      self.offsets = (rng.uniform(0, self.width, num_hashes) -
+                      mean.dot(self.projections))
+      # random odd multipliers turn a hash vector into one int64 key; int64
+      # arithmetic wraps around, which is fine for hashing
+      self.multipliers = rng.randint(1, 2 ** 62, self.hash_size,
+                                     dtype=np.int64) | 1
+
+    keys = self._keys(self._hash(X)[0])
+    self.table_order = np.argsort(keys, axis=0, kind='stable')
+    self.table_keys = np.take_along_axis(keys, self.table_order, axis=0)
+    self.num_indexed = X.shape[0]
+    self.pending_keys = np.zeros((0, self.num_tables), dtype=np.int64)
+
+  def add(self, X, data):
+    """
+    Hash new training points.
+
+    Inputs:
+    - X: A numpy array of shape (num_new, D) of the new points.
+    - data: The whole training set after the addition, of which X are the
+      last rows; a reference is kept for re-ranking.
+    """
+    self.data = data
+    self._sq_norms_buffer, self.sq_norms = append_rows(
+      getattr(self, '_sq_norms_buffer', None), self.sq_norms,
+      np.sum(X.astype(np.float64) ** 2, axis=1))
+    self._pending_buffer, self.pending_keys = append_rows(
+      getattr(self, '_pending_buffer', None), self.pending_keys,
+      self._keys(self._hash(X)[0]))
+
+    num_pending = self.pending_keys.shape[0]
+    if num_pending > PENDING_FRACTION * self.num_indexed:
+      keys = np.concatenate((self.table_keys, self.pending_keys))
+      ids = np.concatenate((self.table_order, np.broadcast_to(
+        np.arange(num_pending).reshape(-1, 1) + self.num_indexed,
+        self.pending_keys.shape)))
+      order = np.argsort(keys, axis=0, kind='stable')
+      self.table_keys = np.take_along_axis(keys, order, axis=0)
+      self.table_order = np.take_along_axis(ids, order, axis=0)
+      self.num_indexed += num_pending
+      self.pending_keys = self.pending_keys[:0]
+
+  def _hash(self, X):
+    """
+    Returns a tuple of:
+    - h: Integer array of shape (N, num_tables, hash_size) of hash values.
+    - margin: Array of the same shape. For 'hyperplane' the distance of the
+      projection to its hyperplane; for 'pstable' the position of the
+      projection inside its bucket, in [0, 1).
+    """
+    proj = (X.dot(self.projections) + self.offsets) / self.width
+    if self.family == 'hyperplane':
+      h = (proj > 0).astype(np.int64)
+      margin = np.abs(proj)
+    else:
+      h = np.floor(proj).astype(np.int64)
+      margin = proj - h
+    shape = (X.shape[0], self.num_tables, self.hash_size)
+    return h.reshape(shape), margin.reshape(shape)
+
+  def _keys(self, h):
+    """ Integer array of shape (N, num_tables) of bucket keys. """
+    return np.sum(h * self.multipliers, axis=2)
+
+  def _probe_keys(self, X, num_probes):
+    """
+    Keys of the buckets probed for every query.
+
+    Returns an integer array of shape (num_test, num_tables, 1 + num_probes)
+    whose first entry is the query's own bucket.
+    """
+    h, margin = self._hash(X)
+    keys = self._keys(h)
+    if num_probes == 0:
+      return keys[:, :, None]
+    if self.family == 'hyperplane':
+      # flipping bit j moves the key by +2^j or -2^j
+      steps = np.where(h == 1, -1, 1) * self.multipliers
+      scores = margin
+    else:
+      # moving down or up one bucket in function j, scored by the distance
+      # of the projection to that boundary
+      steps = np.concatenate((-np.broadcast_to(self.multipliers, h.shape),
+                              np.broadcast_to(self.multipliers, h.shape)),
+                             axis=2)
+      scores = np.concatenate((margin, 1 - margin), axis=2)
+    num_probes = min(num_probes, scores.shape[2])
+    best = np.argsort(scores, axis=2)[:, :, :num_probes]
+    probes = keys[:, :, None] + np.take_along_axis(steps, best, axis=2)
+    return np.concatenate((keys[:, :, None], probes), axis=2)
+
+  def query(self, X, k=1, num_probes=None, batch_size=256):
+    """
+    Approximate k-nearest-neighbor search.
+
+    Inputs:
+    - X: A numpy array of shape (num_test, D) of query points.
+    - k: The number of neighbors to find.
+    - num_probes: Overrides the number of probes given at construction.
+    - batch_size: The number of queries whose candidates are gathered and
+      re-ranked together.
+
+    Returns a tuple of:
+    - neighbors: A numpy array of shape (num_test, k) of indices into the
+      training points, ordered from closest to farthest.
+    - dists: A numpy array of shape (num_test, k) of Euclidean distances.
+    """
+    if num_probes is None:
+      num_probes = self.num_probes
+    num_test = X.shape[0]
+    k = min(k, self.data.shape[0])
+    neighbors = np.zeros((num_test, k), dtype=np.intp)
+    dists = np.zeros((num_test, k))
+    self.last_num_candidates = 0
+    for i0 in range(0, num_test, batch_size):
+      X_batch = X[i0:i0 + batch_size]
+      query_ids, cand_ids = self._candidates(X_batch, num_probes)
+      self.last_num_candidates += cand_ids.size
+      nb, d = _rank_candidates(X_batch, query_ids, cand_ids, self.data,
+                               self.sq_norms, k)
+      neighbors[i0:i0 + batch_size] = nb
+      dists[i0:i0 + batch_size] = d
+    return neighbors, dists
+
+  def _candidates(self, X, num_probes):
+    """
+    Gather the distinct training points that share a probed bucket with each
+    query.
+
+    Returns a tuple (query_ids, cand_ids) of equally long integer arrays,
+    sorted by query, listing (query, training point) pairs.
+    """
+    num_train = self.data.shape[0]
+    probe_keys = self._probe_keys(X, num_probes)
+    tables = [(self.table_keys, self.table_order)]
+    if self.pending_keys.shape[0] > 0:
+      pending_order = np.argsort(self.pending_keys, axis=0)
+      tables.append((np.take_along_axis(self.pending_keys, pending_order, 0),
+                     pending_order + self.num_indexed))
+
+    query_ids, cand_ids = [], []
+    for table_keys, table_order in tables:
+      for t in range(self.num_tables):
+        keys = probe_keys[:, t, :].ravel()
+        lo = np.searchsorted(table_keys[:, t], keys, side='left')
+        hi = np.searchsorted(table_keys[:, t], keys, side='right')
+        positions, owners = _expand_ranges(lo, hi)
+        cand_ids.append(table_order[positions, t])
+        query_ids.append(owners // probe_keys.shape[2])
+    pairs = np.unique(np.concatenate(query_ids).astype(np.int64) * num_train +
+                      np.concatenate(cand_ids))
+    return pairs // num_train, pairs % num_train
+
+
+def _rank_candidates(X, query_ids, cand_ids, data, sq_norms, k,
+                     memory_budget=64 * 1024 ** 2):
+  """
+  Pick the k closest of every query's candidates with exact L2 distances.
+  Queries with fewer than k candidates are compared to every training point.
+
+  Inputs:
+  - X: Array of shape (num_test, D) of queries.
+  - query_ids, cand_ids: Equally long integer arrays, sorted by query, of
+    distinct (query, training point) pairs to score.
+  - data: Array of shape (num_train, D) of training points.
+  - sq_norms: Array of shape (num_train,) of squared training norms.
+  - k: Number of neighbors to keep, at most num_train.
+  - memory_budget: Approximate number of bytes used for gathered rows.
+
+  Returns a tuple (neighbors, dists) of arrays of shape (num_test, k), sorted
+  by increasing distance.
+  """
+  num_test, dim = X.shape
+  X = X.astype(np.float64)
+  test_sq = np.sum(X ** 2, axis=1)
+  neighbors = np.zeros((num_test, k), dtype=np.intp)
+  dists = np.zeros((num_test, k))
+
+  counts = np.bincount(query_ids, minlength=num_test)
+  short = np.nonzero(counts < k)[0]
+  if short.size > 0:
+    # not enough candidates: scan the whole training set for these queries
+    d = -2 * X[short].dot(data.T) + test_sq[short].reshape(-1, 1) + sq_norms
+    best = np.argsort(d, axis=1)[:, :k]
+    neighbors[short] = best
+    dists[short] = np.take_along_axis(d, best, axis=1)
+    keep = counts[query_ids] >= k
+    query_ids, cand_ids = query_ids[keep], cand_ids[keep]
+    counts[short] = 0
+
+  d = np.zeros(query_ids.size)
+  chunk = max(memory_budget // (16 * dim), 1)
+  for c0 in range(0, query_ids.size, chunk):
+    q, c = query_ids[c0:c0 + chunk], cand_ids[c0:c0 + chunk]
+    d[c0:c0 + chunk] = np.einsum('ij,ij->i', X[q], data[c])
+  d *= -2
+  d += test_sq[query_ids]
+  d += sq_norms[cand_ids]
+
+  full = np.nonzero(counts >= k)[0]
+  neighbors[full], dists[full] = _top_k_pairs(query_ids, cand_ids, d, counts,
+                                              full, k)
+  return neighbors, np.sqrt(np.maximum(dists, 0))
+
+
+def _expand_ranges(lo, hi):
+  """
+  Expand half-open ranges [lo[i], hi[i]) into one flat array.
+
+  Returns a tuple (positions, owners) where owners[j] is the index i of the
+  range that positions[j] came from.
+  """
+  lengths = hi - lo
+  ends = np.cumsum(lengths)
+  if ends.size == 0 or ends[-1] == 0:
+    return np.zeros(0, dtype=np.intp), np.zeros(0, dtype=np.intp)
+  positions = np.arange(ends[-1]) - np.repeat(ends - lengths - lo, lengths)
+  owners = np.repeat(np.arange(lengths.size), lengths)
+  return positions, owners
+
+
+def _top_k_pairs(query_ids, cand_ids, d, counts, rows, k):
+  """
+  Take the k closest candidates of some queries from a list of scored
+  (query, candidate) pairs.
+
+  Inputs:
+  - query_ids, cand_ids, d: Equally long arrays of scored pairs.
+  - counts: Array giving the number of pairs of every query.
+  - rows: Array of the queries to return; each must have at least k pairs.
+  - k: Number of candidates to keep.
+
+  Returns a tuple (neighbors, dists) of arrays of shape (rows.size, k),
+  sorted by increasing d.
+  """
+  # sort the pairs by query, then distance, and take the first k per query
+  order = np.lexsort((d, query_ids))
+  starts = np.cumsum(counts) - counts
+  take = order[(starts[rows].reshape(-1, 1) + np.arange(k))]
+  return cand_ids[take], d[take]
+
+
+def kmeans(X, num_clusters, num_iters=20, seed=0, memory_budget=64 * 1024 ** 2):
+  """
+  Cluster points with Lloyd's k-means algorithm, starting from randomly
+  chosen points. Clusters that become empty are restarted at random points.
+
+  Inputs:
+  - X: A numpy array of shape (N, D) of points.
+  - num_clusters: The number of clusters K; at most N.
+  - num_iters: Maximum number of iterations.
+  - seed: Seed for the initialization.
+  - memory_budget: Approximate number of bytes used for the point to
+    centroid distances.
+
+  Returns a tuple of:
+  - centroids: A numpy array of shape (K, D).
+  - assignments: A numpy array of shape (N,) giving the cluster of each point.
+  """
+  rng = np.random.RandomState(seed)
+  X = np.asarray(X, dtype=np.float64)
+  num_points = X.shape[0]
+  num_clusters = min(num_clusters, num_points)
+  centroids = X[rng.choice(num_points, num_clusters, replace=False)]
+  assignments = None
+  for it in range(num_iters):
+    new_assignments = nearest_centroid(X, centroids, memory_budget)
+    if assignments is not None and np.all(new_assignments == assignments):
+      break
+    assignments = new_assignments
+
+    # per-cluster sums over the points sorted by cluster
+    counts = np.bincount(assignments, minlength=num_clusters)
+    order = np.argsort(assignments, kind='stable')
+    used = np.nonzero(counts)[0]
+    starts = np.cumsum(counts)[used] - counts[used]
+    centroids[used] = (np.add.reduceat(X[order], starts, axis=0) /
+                       counts[used].reshape(-1, 1))
+    empty = np.nonzero(counts == 0)[0]
+    centroids[empty] = X[rng.choice(num_points, empty.size, replace=False)]
+  return centroids, assignments
+
+
+def nearest_centroid(X, centroids, memory_budget=64 * 1024 ** 2):
+  """
+  Index of the closest centroid of every point, computed in chunks.
+
+  Inputs:
+  - X: A numpy array of shape (N, D) of points.
+  - centroids: A numpy array of shape (K, D).
+  - memory_budget: Approximate number of bytes used for the distances.
+
+  Returns:
+  - A numpy array of shape (N,) of indices into centroids.
+  """
+  centroid_sq = np.sum(centroids.astype(np.float64) ** 2, axis=1)
+  chunk = max(memory_budget // (8 * centroids.shape[0]), 1)
+  assignments = np.zeros(X.shape[0], dtype=np.intp)
+  for i0 in range(0, X.shape[0], chunk):
+    # ||x||^2 is the same for every centroid and can be left out
+    d = X[i0:i0 + chunk].dot(centroids.T)
+    d *= -2
+    d += centroid_sq
+    assignments[i0:i0 + chunk] = np.argmin(d, axis=1)
+  return assignments
+
+
+class IVFPQIndex(object):
+  """
+  Compressed approximate kNN index: an inverted file over k-means cells with
+  product-quantized residuals (IVF-PQ).
+
+  The training points are split into num_lists cells by k-means. Each point
+  is stored in the list of its cell as its residual to the cell centroid,
+  product-quantized: the D dimensions are cut into num_subspaces groups and
+  every group is replaced by the index of the closest of 256 codewords
+  learned by k-means on that group, so a point costs num_subspaces bytes.
+  The raw training points are not kept.
+
+  A query visits its num_probes closest cells. Distances to the points of a
+  cell are computed asymmetrically: the query residual is exact and only the
+  stored points are quantized, so for every (query, cell) pair a lookup
+  table of query-to-codeword distances is built once and a point's distance
+  is the sum of num_subspaces table entries.
+
+  Points given to add are encoded with the existing centroids and codebooks
+  into a pending list, which is merged into the inverted file once it is
+  large enough.
+  """
+
+  # the raw training data is not needed once the index is built
+  compressed = True
+
+  def __init__(self, num_lists=256, num_subspaces=8, num_probes=8,
+               train_size=None, num_iters=20, seed=0):
+    """
+    Inputs:
+    - num_lists: Number of k-means cells of the inverted file.
+    - num_subspaces: Number of product-quantizer groups, i.e. bytes per
+      stored point.
+    - num_probes: Number of cells visited per query.
+    - train_size: Number of points sampled to learn the centroids and
+      codebooks. Defaults to 64 points per centroid.
+    - num_iters: Number of k-means iterations.
+    - seed: Seed for sampling and k-means.
+    """
+    self.num_lists = num_lists
+    self.num_subspaces = num_subspaces
+    self.num_probes = num_probes
+    self.train_size = train_size
+    self.num_iters = num_iters
+    self.seed = seed
+
+  def build(self, X):
+    """
+    Learn the coarse centroids and codebooks and encode the training points.
+
+    Inputs:
+    - X: A numpy array of shape (num_train, D) of training points.
+    """
+    rng = np.random.RandomState(self.seed)
+    num_train, dim = X.shape
+    if self.num_subspaces > dim:
+      raise ValueError('num_subspaces (%d) exceeds the dimension (%d)' %
+                       (self.num_subspaces, dim))
+    num_lists = min(self.num_lists, num_train)
+    train_size = self.train_size or 64 * max(num_lists, 256)
+    sample = X[np.sort(rng.choice(num_train, min(train_size, num_train),
+                                  replace=False))].astype(np.float64)
+
+    centroids, sample_lists = kmeans(sample, num_lists, self.num_iters,
+                                     self.seed)
+    residuals = sample - centroids[sample_lists]
+    self.bounds = np.linspace(0, dim, self.num_subspaces + 1).astype(np.intp)
+    codebooks = []
+    for m in range(self.num_subspaces):
+      part = np.ascontiguousarray(residuals[:, self.bounds[m]:self.bounds[m + 1]])
+      codebook, _ = kmeans(part, 256, self.num_iters, self.seed + m + 1)
+      codebooks.append(codebook.astype(np.float32))
+    self.centroids = centroids.astype(np.float32)
+    self.codebooks = codebooks
+
+    lists = nearest_centroid(X, centroids)
+    codes = self._encode(X, lists)
+    # store the lists one after the other
+    order = np.argsort(lists, kind='stable')
+    self.ids = order.astype(np.int32)
+    self.codes = codes[order]
+    self.list_offsets = _list_offsets(lists, num_lists)
+    self.pending_ids = np.zeros(0, dtype=np.int32)
+    self.pending_codes = np.zeros((0, self.num_subspaces), dtype=np.uint8)
+    self.pending_lists = np.zeros(0, dtype=np.intp)
+
+  def add(self, X, data=None):
+    """
+    Encode new training points.
+
+    Inputs:
+    - X: A numpy array of shape (num_new, D) of the new points, which get the
+      next training indices.
+    - data: Unused; the index does not keep the raw training data.
+    """
+    num_total = self.ids.shape[0] + self.pending_ids.shape[0]
+    lists = nearest_centroid(X, self.centroids.astype(np.float64))
+    self._ids_buffer, self.pending_ids = append_rows(
+      getattr(self, '_ids_buffer', None), self.pending_ids,
+      np.arange(num_total, num_total + X.shape[0]))
+    self._codes_buffer, self.pending_codes = append_rows(
+      getattr(self, '_codes_buffer', None), self.pending_codes,
+      self._encode(X, lists))
+    self._lists_buffer, self.pending_lists = append_rows(
+      getattr(self, '_lists_buffer', None), self.pending_lists, lists)
+
+    if self.pending_ids.shape[0] > PENDING_FRACTION * self.ids.shape[0]:
+      num_lists = self.centroids.shape[0]
+      main_lists = np.repeat(np.arange(num_lists), np.diff(self.list_offsets))
+      all_lists = np.concatenate((main_lists, self.pending_lists))
+      order = np.argsort(all_lists, kind='stable')
+      self.ids = np.concatenate((self.ids, self.pending_ids))[order]
+      self.codes = np.concatenate((self.codes, self.pending_codes))[order]
+      self.list_offsets = _list_offsets(all_lists, num_lists)
+      self.pending_ids = self.pending_ids[:0]
+      self.pending_codes = self.pending_codes[:0]
+      self.pending_lists = self.pending_lists[:0]
+
+  def _encode(self, X, lists, chunk=4096):
+    """ Product-quantize the residuals of X to the centroids of lists. """
+    codes = np.zeros((X.shape[0], self.num_subspaces), dtype=np.uint8)
+    for i0 in range(0, X.shape[0], chunk):
+      residuals = (X[i0:i0 + chunk] -
+                   self.centroids[lists[i0:i0 + chunk]]).astype(np.float64)
+      for m in range(self.num_subspaces):
+        part = residuals[:, self.bounds[m]:self.bounds[m + 1]]
+        codes[i0:i0 + chunk, m] = nearest_centroid(part, self.codebooks[m])
+    return codes
+
+  @property
+  def nbytes(self):
+    """ Number of bytes held by the index arrays. """
+    return (self.centroids.nbytes + sum(c.nbytes for c in self.codebooks) +
+            self.ids.nbytes + self.codes.nbytes + self.list_offsets.nbytes +
+            self.pending_ids.nbytes + self.pending_codes.nbytes +
+            self.pending_lists.nbytes)
+
+  def query(self, X, k=1, num_probes=None, batch_size=256):
+    """
+    Approximate k-nearest-neighbor search.
+
+    Inputs:
+    - X: A numpy array of shape (num_test, D) of query points.
+    - k: The number of neighbors to find.
+    - num_probes: Overrides the number of cells visited given at
+      construction. Queries whose cells hold fewer than k points are
+      searched again over every cell.
+    - batch_size: The number of queries searched together.
+
+    Returns a tuple of:
+    - neighbors: A numpy array of shape (num_test, k) of indices into the
+      training points, ordered from closest to farthest.
+    - dists: A numpy array of shape (num_test, k) of approximate Euclidean
+      distances.
+    """
+    if num_probes is None:
+      num_probes = self.num_probes
+    num_lists = self.centroids.shape[0]
+    num_test = X.shape[0]
+    k = min(k, self.ids.shape[0] + self.pending_ids.shape[0])
+    neighbors = np.zeros((num_test, k), dtype=np.intp)
+    dists = np.zeros((num_test, k))
+    # the inverted file, and the pending points sorted into lists
+    runs = [(self.list_offsets, self.ids, self.codes)]
+    if self.pending_ids.shape[0] > 0:
+      order = np.argsort(self.pending_lists, kind='stable')
+      runs.append((_list_offsets(self.pending_lists, num_lists),
+                   self.pending_ids[order], self.pending_codes[order]))
+    self.last_num_candidates = 0
+    for i0 in range(0, num_test, batch_size):
+      X_batch = X[i0:i0 + batch_size].astype(np.float64)
+      nb, d, short = self._query_batch(X_batch, k, min(num_probes, num_lists),
+                                       runs)
+      if short.size > 0:
+        nb[short], d[short], _ = self._query_batch(X_batch[short], k,
+                                                   num_lists, runs)
+      neighbors[i0:i0 + batch_size] = nb
+      dists[i0:i0 + batch_size] = d
+    return neighbors, np.sqrt(np.maximum(dists, 0))
+
+  def _query_batch(self, Q, k, num_probes, runs):
+    """
+    Search a batch of queries in runs, a list of (list_offsets, ids, codes)
+    inverted files.
+
+    Returns a tuple (neighbors, dists, short) where dists are squared and
+    short lists the queries with fewer than k candidates, whose rows are left
+    at zero.
+    """
+    num_queries = Q.shape[0]
+    num_lists = self.centroids.shape[0]
+    centroids = self.centroids.astype(np.float64)
+    coarse = np.sum(centroids ** 2, axis=1) - 2 * Q.dot(centroids.T)
+    if num_probes < num_lists:
+      probed = np.argpartition(coarse, num_probes - 1, axis=1)[:, :num_probes]
+    else:
+      probed = np.broadcast_to(np.arange(num_lists), coarse.shape)
+
+    # one lookup table per (query, probed cell) pair: the squared distances
+    # from each group of the query residual to every codeword of that group
+    pair_query = np.repeat(np.arange(num_queries), num_probes)
+    pair_list = probed.ravel()
+    residuals = Q[pair_query] - centroids[pair_list]
+    tables = np.zeros((pair_list.size, self.num_subspaces, 256))
+    for m, codebook in enumerate(self.codebooks):
+      part = residuals[:, self.bounds[m]:self.bounds[m + 1]]
+      codebook = codebook.astype(np.float64)
+      tables[:, m, :codebook.shape[0]] = (
+        np.sum(part ** 2, axis=1).reshape(-1, 1) - 2 * part.dot(codebook.T) +
+        np.sum(codebook ** 2, axis=1))
+
+    query_ids, cand_ids, cand_d = [], [], []
+    for list_offsets, ids, codes in runs:
+      positions, pairs = _expand_ranges(list_offsets[pair_list],
+                                        list_offsets[pair_list + 1])
+      self.last_num_candidates += positions.size
+      run_codes = codes[positions]
+      d = np.zeros(positions.size)
+      for m in range(self.num_subspaces):
+        d += tables[pairs, m, run_codes[:, m]]
+      query_ids.append(pair_query[pairs])
+      cand_ids.append(ids[positions])
+      cand_d.append(d)
+    query_ids = np.concatenate(query_ids)
+
+    counts = np.bincount(query_ids, minlength=num_queries)
+    full = np.nonzero(counts >= k)[0]
+    neighbors = np.zeros((num_queries, k), dtype=np.intp)
+    dists = np.zeros((num_queries, k))
+    neighbors[full], dists[full] = _top_k_pairs(
+      query_ids, np.concatenate(cand_ids), np.concatenate(cand_d), counts,
+      full, k)
+    return neighbors, dists, np.nonzero(counts < k)[0]
+
+
+def _list_offsets(lists, num_lists):
+  """
+  Offsets of every list in an array sorted by list: list l occupies
+  [offsets[l], offsets[l + 1]).
+  """
+  return np.concatenate(([0], np.cumsum(np.bincount(lists,
+                                                    minlength=num_lists))))
+
+
+# index names accepted by KNearestNeighbor(index=...)
+INDEX_TYPES = {
+  'balltree': BallTree,
+  'kdtree': KDTree,
+  'lsh': LSHIndex,
+  'ivfpq': IVFPQIndex,
+}
@@ -1,22 +1,146 @@
 from __future__ import print_function
 
 import numpy as np
+from scipy.linalg import cho_factor, cho_solve, eigh
+from scipy.optimize import minimize
+from scipy.sparse import csr_matrix, issparse
+
+from cs231n.workspace import dot_into
 from cs231n.classifiers.linear_svm import *
 from cs231n.classifiers.softmax import *
 
+
+class EpochSampler(object):
+  """
+  Minibatch sampler that draws one random permutation of the training set
+  per epoch and walks it in consecutive slices, so every training example
+  is used exactly once per epoch. A batch that reaches the end of a
+  permutation is completed from the next one; all batches have batch_size
+  examples.
+
+  Drawing the permutation costs O(N) once per epoch, so a batch costs
+  amortized O(batch_size), where np.random.choice(N, batch_size,
+  replace=False) costs O(N) per batch.
+  """
+
+  def __init__(self, num_train, batch_size):
+    self.num_train = num_train
+    self.batch_size = batch_size
+    self.epoch = 0
+    self.order = np.random.permutation(num_train)
+    self.position = 0
+    self.indices = np.empty(batch_size, dtype=np.intp)
+
+  def next_batch(self):
+    """
+    Returns:
+    - An array of shape (batch_size,) of indices into the training set. It
+      is overwritten by the next call.
+    """
+    filled = 0
+    while filled < self.batch_size:
+      if self.position == self.num_train:
+        self.epoch += 1
+        self.order = np.random.permutation(self.num_train)
+        self.position = 0
+      take = min(self.batch_size - filled, self.num_train - self.position)
+      self.indices[filled:filled + take] = \
+        self.order[self.position:self.position + take]
+      filled += take
+      self.position += take
+    return self.indices
+
+
+def _minibatch_reader(X, batch_size, dtype, feature_map=None):
+  """
+  Build the function that turns the indices of a minibatch into the input of
+  the loss, in buffers allocated once.
+
+  Rows of a dense X are gathered with np.take and, if X has another dtype
+  than the weights, converted to it, so the loss is never upcast; a sparse X
+  is converted to a CSR matrix of that dtype once and sliced. With a feature
+  map, the features of the rows are returned instead.
+
+  Inputs:
+  - X: A numpy array or scipy.sparse matrix of shape (N, D) of training data.
+  - batch_size: Number of indices of a minibatch.
+  - dtype: The dtype of the weights.
+  - feature_map: An optional fitted feature map.
+
+  Returns:
+  - read: A function mapping an array of batch_size indices to an array or
+    CSR matrix of their inputs; arrays are overwritten by the next call.
+  """
+  if issparse(X):
+    X = csr_matrix(X, dtype=dtype)
+    gather = X.__getitem__
+  else:
+    X_batch = np.empty((batch_size, X.shape[1]), dtype=X.dtype)
+
+    def gather(indices):
+      return np.take(X, indices, axis=0, out=X_batch)
+
+  if feature_map is not None:
+    features = np.empty((batch_size, feature_map.num_features),
+                        dtype=feature_map.dtype)
+    return lambda indices: feature_map.transform(gather(indices), out=features)
+  if issparse(X) or X.dtype == dtype:
+    return gather
+  converted = np.empty((batch_size, X.shape[1]), dtype=dtype)
+
+  def read(indices):
+    converted[...] = gather(indices)
+    return converted
+  return read
+
+
+def _fit_feature_map(feature_map, X, dtype):
+  """
+  Fit a feature map on X, computing its features in dtype, the dtype of the
+  weights of the classifiers that use it, so that neither the loss nor the
+  scores are upcast.
+  """
+  feature_map.dtype = dtype
+  return feature_map.fit(X)
+
+
 class LinearClassifier(object):
 
-  def __init__(self):
+  def __init__(self, feature_map=None, dtype=np.float64):
+    """
+    Inputs:
+    - feature_map: An optional feature map of cs231n.kernel_features, such as
+      RandomFourierFeatures, applied to the data before the linear model, so
+      that the classifier approximates a kernel machine. It is fit on the
+      training data, in the dtype of the weights, the first time the
+      classifier is trained; minibatches and prediction chunks are
+      transformed as they are used.
+    - dtype: The dtype of the weights, np.float64 or np.float32. SGD runs in
+      this dtype: minibatches of data of another dtype are converted as they
+      are drawn, so float32 training halves the memory traffic and roughly
+      doubles the BLAS throughput of float64 without any upcast.
+    """
     self.W = None
+    self.feature_map = feature_map
+    self.dtype = dtype
 
   def train(self, X, y, learning_rate=1e-3, reg=1e-5, num_iters=100,
             batch_size=200, verbose=False):
     """
     Train this linear classifier using stochastic gradient descent.
 
+    Minibatches are drawn by an EpochSampler, so every training example is
+    visited once per epoch of N / batch_size iterations, and gathered into
+    buffers allocated once. The loss is computed in a workspace kept for the
+    whole call, so after the first iteration no arrays are allocated.
+
+    X may also be a scipy.sparse matrix, such as bag-of-words features, which
+    is converted to CSR once; minibatches are then sliced as CSR matrices and
+    the scores and gradients cost O(nonzeros * C) instead of O(N * D * C).
+
     Inputs:
-    - X: A numpy array of shape (N, D) containing training data; there are N
-      training samples each of dimension D.
+    - X: A numpy array or scipy.sparse matrix of shape (N, D) containing
+      training data; there are N training samples each of dimension D.
     - y: A numpy array of shape (N,) containing training labels; y[i] = c
       means that X[i] has label 0 <= c < C for C classes.
     - learning_rate: (float) learning rate for optimization.
@@ -30,16 +154,24 @@ class LinearClassifier(object):
     """
     num_train, dim = X.shape
     num_classes = np.max(y) + 1 # assume y takes values 0...K-1 where K is number of classes
+    if self.feature_map is not None and self.W is None:
+      _fit_feature_map(self.feature_map, X, self.dtype)
     if self.W is None:
       # lazily initialize W
-      self.W = 0.001 * np.random.randn(dim, num_classes)
+      weight_dim = dim
+      if self.feature_map is not None:
+        weight_dim = self.feature_map.num_features
+      self.W = (0.001 * np.random.randn(weight_dim, num_classes)).astype(
+        self.dtype)
 
     # Run stochastic gradient descent to optimize W
     loss_history = []
+    sampler = EpochSampler(num_train, batch_size)
+    read_batch = _minibatch_reader(X, batch_size, self.W.dtype,
+                                   self.feature_map)
+    y_batch = np.empty(batch_size, dtype=y.dtype)
+    workspace = {}
     for it in range(num_iters):
-      X_batch = None
-      y_batch = None
-
       #########################################################################
       # TODO:                                                                 #
       # Sample batch_size elements from the training data and their           #
@@ -51,15 +183,15 @@ class LinearClassifier(object):
       # Hint: Use np.random.choice to generate indices. Sampling with         #
       # replacement is faster than sampling without replacement.              #
       #########################################################################
-      selected_elems = np.random.choice(X.shape[0], batch_size, replace=False) 
-      X_batch = X[selected_elems, :]
-      y_batch = y[selected_elems]
+      selected_elems = sampler.next_batch()
+      X_batch = read_batch(selected_elems)
+      np.take(y, selected_elems, out=y_batch)
       #########################################################################
       #                       END OF YOUR CODE                                #
       #########################################################################
 
       # evaluate loss and gradient
-      loss, grad = self.loss(X_batch, y_batch, reg)
+      loss, grad = self.loss(X_batch, y_batch, reg, workspace)
       loss_history.append(loss)
 
       # perform parameter update
@@ -67,7 +199,9 @@ class LinearClassifier(object):
       # TODO:                                                                 #
       # Update the weights using the gradient and the learning rate.          #
       #########################################################################
-      self.W += - learning_rate * grad
+      # grad is a workspace buffer and can be scaled in place
+      grad *= learning_rate
+      self.W -= grad
       #########################################################################
       #                       END OF YOUR CODE                                #
       #########################################################################
@@ -77,33 +211,187 @@ class LinearClassifier(object):
 
     return loss_history
 
+  @classmethod
+  def train_grid(cls, X, y, learning_rates, regs, num_iters=100,
+                 batch_size=200, verbose=False, feature_map=None,
+                 dtype=np.float64):
+    """
+    Train one classifier for every (learning_rate, reg) pair of a grid
+    search at once, using stochastic gradient descent as train does.
+
+    The weights of the G = len(learning_rates) * len(regs) models are held in
+    one (G, D, C) array and every model sees the same minibatches, so each
+    iteration costs one call of batched_loss, whose two matrix products cover
+    all models. This is a few times the cost of a single train call rather
+    than G times. All models start from the same random weights; with the
+    same seed, each one matches a separate train call up to rounding.
+
+    Inputs:
+    - X, y, num_iters, batch_size, verbose: As for train.
+    - learning_rates: A sequence of learning rates.
+    - regs: A sequence of regularization strengths.
+    - feature_map: An optional feature map, fit on X and shared by all the
+      trained classifiers.
+    - dtype: The dtype of the weights, as for the constructor.
+
+    Returns a tuple of:
+    - models: A dictionary mapping each (learning_rate, reg) pair to a trained
+      classifier of this class.
+    - loss_histories: A dictionary mapping each (learning_rate, reg) pair to
+      the list of the loss of that model at each iteration.
+    """
+    if cls.batched_loss is LinearClassifier.batched_loss:
+      raise TypeError('%s has no batched_loss, so it cannot be trained with '
+                      'train_grid' % cls.__name__)
+    num_train, dim = X.shape
+    num_classes = np.max(y) + 1
+    grid = [(lr, reg) for lr in learning_rates for reg in regs]
+    num_models = len(grid)
+    lr = np.array([p[0] for p in grid], dtype=np.float64).reshape(-1, 1, 1)
+    reg = np.array([p[1] for p in grid], dtype=dtype)
+    weight_dim = dim
+    if feature_map is not None:
+      _fit_feature_map(feature_map, X, dtype)
+      weight_dim = feature_map.num_features
+
+    # (G, D, C) view of a (D, G, C) array, so that the weights of all models
+    # form one (D, G * C) matrix without copying. Every model starts from the
+    # one draw train would make, so that with the same seed it follows a
+    # separate train call
+    W0 = (0.001 * np.random.randn(weight_dim, num_classes)).astype(dtype)
+    W = np.empty((weight_dim, num_models, num_classes), dtype=dtype)
+    W[:] = W0[:, np.newaxis, :]
+    W = W.transpose(1, 0, 2)
+
+    loss_history = np.zeros((num_iters, num_models))
+    sampler = EpochSampler(num_train, batch_size)
+    read_batch = _minibatch_reader(X, batch_size, dtype, feature_map)
+    y_batch = np.empty(batch_size, dtype=y.dtype)
+    for it in range(num_iters):
+      selected_elems = sampler.next_batch()
+      X_batch = read_batch(selected_elems)
+      np.take(y, selected_elems, out=y_batch)
+
+      loss, grad = cls.batched_loss(W, X_batch, y_batch, reg)
+      loss_history[it] = loss
+      grad *= lr
+      W -= grad
+
+      if verbose and it % 100 == 0:
+        print('iteration %d / %d: best loss %f' % (it, num_iters,
+                                                   np.nanmin(loss)))
+
+    models = {}
+    loss_histories = {}
+    for g, params in enumerate(grid):
+      models[params] = cls(feature_map, dtype)
+      models[params].W = np.ascontiguousarray(W[g])
+      loss_histories[params] = list(loss_history[:, g])
+    return models, loss_histories
+
   def predict(self, X):
     """
     Use the trained weights of this linear classifier to predict labels for
     data points.
 
     Inputs:
-    - X: A numpy array of shape (N, D) containing training data; there are N
-      training samples each of dimension D.
+    - X: A numpy array or scipy.sparse matrix of shape (N, D) containing
+      training data; there are N training samples each of dimension D.
 
     Returns:
     - y_pred: Predicted labels for the data in X. y_pred is a 1-dimensional
       array of length N, and each element is an integer giving the predicted
       class.
     """
+    if self.feature_map is not None:
+      # the features of all of X may not fit in memory
+      return self.predict_stream(X)
     y_pred = np.zeros(X.shape[0])
     ###########################################################################
     # TODO:                                                                   #
     # Implement this method. Store the predicted labels in y_pred.            #
     ###########################################################################
-    scores = np.dot(X, self.W)
+    scores = X.dot(self.W)
     y_pred = np.argmax ( scores, axis = 1)
     ###########################################################################
     #                           END OF YOUR CODE                              #
     ###########################################################################
     return y_pred
-  
-  def loss(self, X_batch, y_batch, reg):
+
+  def predict_stream(self, X, chunk_size=4096, out=None):
+    """
+    Predict labels for data too large to hold in memory, one block of rows
+    at a time.
+
+    Each block is scored into a scores buffer allocated once and its labels
+    are written straight into the output array, so apart from the labels the
+    memory used is O(chunk_size * (D + C)) whatever the number of points.
+    With a feature map, the features are likewise computed one block at a
+    time. For a np.memmap, only the rows of the current block are read from
+    disk; the operating system may keep the pages read in its cache, but
+    can reclaim them at any time.
+
+    Inputs:
+    - X: An array of shape (N, D), typically a np.memmap opened in read
+      mode, which is scored in blocks of chunk_size rows; or an iterable of
+      arrays of shape (N_i, D), which are scored one at a time, each with
+      at most chunk_size rows.
+    - chunk_size: (integer) number of rows scored at a time.
+    - out: An optional preallocated integer array of shape (N,) receiving
+      the labels. It is required to avoid growing a list of per-chunk labels
+      when X is an iterable whose total length is not known.
+
+    Returns:
+    - y_pred: The predicted labels, as predict would return them; this is
+      out, if given.
+    """
+    if hasattr(X, 'shape'):
+      num_test = X.shape[0]
+      chunks = (X[i0:i0 + chunk_size] for i0 in range(0, num_test, chunk_size))
+      if out is None:
+        out = np.empty(num_test, dtype=np.intp)
+    else:
+      chunks = X
+    pieces = []
+    scores = None
+    features = None
+    start = 0
+    for chunk in chunks:
+      n = chunk.shape[0]
+      if self.feature_map is not None:
+        if features is None or features.shape[0] < n:
+          features = np.empty((max(n, chunk_size),
+                               self.feature_map.num_features),
+                              dtype=self.feature_map.dtype)
+        chunk = self.feature_map.transform(chunk, out=features[:n])
+      elif chunk.dtype != self.W.dtype:
+        chunk = chunk.astype(self.W.dtype)
+      dtype = np.result_type(chunk.dtype, self.W.dtype)
+      if scores is None or scores.shape[0] < n or scores.dtype != dtype:
+        scores = np.empty((max(n, chunk_size), self.W.shape[1]), dtype=dtype)
+      block_scores = dot_into(chunk, self.W, scores[:n])
+      if out is None:
+        pieces.append(np.argmax(block_scores, axis=1))
+      else:
+        np.argmax(block_scores, axis=1, out=out[start:start + n])
+      start += n
+    if out is None:
+      return np.concatenate(pieces) if pieces else np.empty(0, dtype=np.intp)
+    return out
+
+  def _full_batch_features(self, X):
+    """
+    The training data seen by the full-batch solvers: X itself, or its
+    features if the classifier has a feature map, which is fit on X first
+    unless the classifier was trained before.
+    """
+    if self.feature_map is None:
+      return X
+    if self.W is None:
+      _fit_feature_map(self.feature_map, X, self.dtype)
+    return self.feature_map.transform(X)
+
+  def loss(self, X_batch, y_batch, reg, workspace=None):
     """
     Compute the loss function and its derivative. 
     Subclasses will override this.
@@ -113,6 +401,9 @@ class LinearClassifier(object):
       data points; each point has dimension D.
     - y_batch: A numpy array of shape (N,) containing labels for the minibatch.
     - reg: (float) regularization strength.
+    - workspace: If given, a dictionary of scratch buffers reused across
+      calls; the returned gradient is then one of them and is overwritten by
+      the next call with the same workspace.
 
     Returns: A tuple containing:
     - loss as a single float
@@ -120,17 +411,294 @@ class LinearClassifier(object):
     """
     pass
 
+  @staticmethod
+  def batched_loss(W, X_batch, y_batch, reg):
+    """
+    Compute the loss function and its derivative for several models at once,
+    as used by train_grid. Subclasses will override this.
+
+    Inputs:
+    - W: A numpy array of shape (G, D, C) containing the weights of G models.
+    - X_batch, y_batch: As for loss.
+    - reg: A numpy array of shape (G,) of regularization strengths.
+
+    Returns: A tuple containing:
+    - an array of shape (G,) of losses
+    - gradient with respect to W; an array of the same shape as W
+    """
+    pass
+
 
 class LinearSVM(LinearClassifier):
   """ A subclass that uses the Multiclass SVM loss function """
 
-  def loss(self, X_batch, y_batch, reg):
+  def train(self, X, y, learning_rate=1e-3, reg=1e-5, num_iters=100,
+            batch_size=200, verbose=False, solver='sgd', tol=0.1):
+    """
+    Train this classifier with minibatch SGD or with dual coordinate descent.
+
+    Inputs:
+    - X, y, learning_rate, reg, batch_size, verbose: As for
+      LinearClassifier.train; learning_rate and batch_size are only used by
+      'sgd'.
+    - num_iters: (integer) number of steps of SGD, or maximum number of
+      epochs of 'dcd'.
+    - solver: 'sgd' for LinearClassifier.train on the multiclass SVM loss,
+      or 'dcd' for svm_dual_coordinate_descent, which trains one-vs-rest
+      SVMs with the same regularization to optimality in a few epochs, with
+      no learning rate to tune. Note that the one-vs-rest hinge loss is not
+      the multiclass loss of svm_loss_vectorized.
+    - tol: Stopping tolerance of 'dcd'.
+
+    Outputs:
+    A list containing the value of the loss function at each iteration
+    ('sgd') or of svm_ovr_objective after each epoch ('dcd').
+    """
+    if solver == 'sgd':
+      return super(LinearSVM, self).train(X, y, learning_rate, reg, num_iters,
+                                          batch_size, verbose)
+    if solver != 'dcd':
+      raise ValueError('Unknown solver "%s"' % solver)
+    num_classes = np.max(y) + 1
+    X = self._full_batch_features(X)
+    # the solver itself runs in float64
+    W, loss_history = svm_dual_coordinate_descent(
+      X, y, num_classes, reg, max_epochs=num_iters, tol=tol, verbose=verbose)
+    self.W = W.astype(self.dtype, copy=False)
+    return loss_history
+
+  def loss(self, X_batch, y_batch, reg, workspace=None):
+    if workspace is not None:
+      return svm_loss_inplace(self.W, X_batch, y_batch, reg, workspace)
     return svm_loss_vectorized(self.W, X_batch, y_batch, reg)
 
+  @staticmethod
+  def batched_loss(W, X_batch, y_batch, reg):
+    return svm_loss_batched(W, X_batch, y_batch, reg)
+
 
 class Softmax(LinearClassifier):
   """ A subclass that uses the Softmax + Cross-entropy loss function """
 
-  def loss(self, X_batch, y_batch, reg):
+  # scipy.optimize.minimize methods behind the full-batch solvers of train
+  SOLVERS = {'lbfgs': 'L-BFGS-B', 'newton-cg': 'Newton-CG'}
+
+  def train(self, X, y, learning_rate=1e-3, reg=1e-5, num_iters=100,
+            batch_size=200, verbose=False, solver='sgd', tol=1e-6):
+    """
+    Train this classifier with minibatch SGD or with a full-batch solver.
+
+    The softmax loss is convex and smooth, so the quasi-Newton and Newton
+    solvers reach its minimum in tens of iterations over the whole training
+    set, with no learning rate to tune, where SGD needs thousands of steps.
+
+    Inputs:
+    - X, y, learning_rate, reg, batch_size, verbose: As for
+      LinearClassifier.train; learning_rate and batch_size are only used by
+      'sgd'.
+    - num_iters: (integer) number of steps of SGD, or maximum number of
+      iterations of the other solvers.
+    - solver: 'sgd' for LinearClassifier.train, 'lbfgs' for L-BFGS on
+      softmax_loss_vectorized, or 'newton-cg' for Newton conjugate gradient,
+      which also uses exact Hessian-vector products.
+    - tol: Tolerance of the full-batch solvers: they stop early once the
+      loss or the gradient stops changing by more than about tol.
+
+    Outputs:
+    A list containing the value of the loss function at each iteration.
+    """
+    if solver == 'sgd':
+      return super(Softmax, self).train(X, y, learning_rate, reg, num_iters,
+                                        batch_size, verbose)
+    if solver not in self.SOLVERS:
+      raise ValueError('Unknown solver "%s"' % solver)
+
+    X = self._full_batch_features(X)
+    num_train, dim = X.shape
+    num_classes = np.max(y) + 1
+    if self.W is None:
+      self.W = 0.001 * np.random.randn(dim, num_classes)
+    shape = self.W.shape
+    # scipy.optimize works in float64; the result is converted to self.dtype
+
+    # the last evaluated loss, and the probabilities shared by the Hessian
+    # products at the same point
+    state = {'loss': None, 'W': None, 'probs': None}
+
+    def objective(w):
+      loss, dW = softmax_loss_vectorized(w.reshape(shape), X, y, reg)
+      state['loss'] = loss
+      return loss, dW.ravel()
+
+    def hessian_product(w, v):
+      if state['W'] is None or not np.array_equal(state['W'], w):
+        state['W'] = w.copy()
+        state['probs'] = softmax_probabilities(w.reshape(shape), X)
+      return softmax_hessian_product(w.reshape(shape), X, reg,
+                                     v.reshape(shape),
+                                     state['probs']).ravel()
+
+    loss_history = []
+
+    def callback(w):
+      loss_history.append(state['loss'])
+      if verbose and len(loss_history) % 10 == 0:
+        print('iteration %d / %d: loss %f' % (len(loss_history), num_iters,
+                                              state['loss']))
+
+    result = minimize(objective, self.W.ravel(), jac=True,
+                      method=self.SOLVERS[solver],
+                      hessp=hessian_product if solver == 'newton-cg' else None,
+                      tol=tol, callback=callback,
+                      options={'maxiter': num_iters})
+    self.W = result.x.reshape(shape).astype(self.dtype, copy=False)
+    return loss_history
+
+  def loss(self, X_batch, y_batch, reg, workspace=None):
+    if workspace is not None:
+      return softmax_loss_inplace(self.W, X_batch, y_batch, reg, workspace)
     return softmax_loss_vectorized(self.W, X_batch, y_batch, reg)
 
+  @staticmethod
+  def batched_loss(W, X_batch, y_batch, reg):
+    return softmax_loss_batched(W, X_batch, y_batch, reg)
+
+
+class RidgeClassifier(LinearClassifier):
+  """
+  A subclass that fits W in closed form, by ridge regression of the one-hot
+  encoding of the labels: W minimizes
+
+    sum_i ||X[i].dot(W) - T[i]||^2 / N + reg * sum(W * W)
+
+  where T[i, c] is 1 if y[i] == c and 0 otherwise. There is no learning rate
+  or number of iterations to tune, which makes it a quick baseline. Instead
+  of train_grid, train_path fits a whole path of regularization strengths
+  at once.
+  """
+
+  def train(self, X, y, *, reg=1e-5, chunk_size=4096, verbose=False):
+    """
+    Fit W with one Cholesky solve of (X.T X + N * reg * I) W = X.T T.
+
+    X.T X and X.T T are accumulated chunk_size rows at a time in float64, so
+    X can be a np.memmap or a scipy.sparse matrix larger than memory; the
+    work is O(N * D^2) for the accumulation and O(D^3) for the solve.
+
+    Inputs:
+    - X: A numpy array or scipy.sparse matrix of shape (N, D) containing
+      training data.
+    - y: A numpy array of shape (N,) containing training labels.
+    - reg: (float) regularization strength; must be positive unless X.T X
+      is invertible. It and the following arguments are keyword-only, so
+      that a call written for LinearClassifier.train, whose third argument
+      is the learning rate, fails instead of running with the wrong reg.
+    - chunk_size: (integer) number of rows accumulated at a time.
+    - verbose: (boolean) If true, print the training loss.
+
+    Outputs:
+    A list containing the value of the loss function at the solution.
+    """
+    num_classes = np.max(y) + 1
+    if self.feature_map is not None and self.W is None:
+      _fit_feature_map(self.feature_map, X, self.dtype)
+    gram, targets = _ridge_statistics(X, y, num_classes, chunk_size,
+                                      self.feature_map)
+    num_train = X.shape[0]
+    system = gram.copy()
+    system.flat[::system.shape[0] + 1] += num_train * reg
+    W = cho_solve(cho_factor(system), targets)
+    self.W = W.astype(self.dtype, copy=False)
+    loss = _ridge_objective(W, gram, targets, num_train, reg)
+    if verbose:
+      print('loss %f' % loss)
+    return [loss]
+
+  @classmethod
+  def train_path(cls, X, y, regs, chunk_size=4096, feature_map=None,
+                 dtype=np.float64):
+    """
+    Fit one classifier for every regularization strength of a path at once.
+
+    X.T X and X.T T are accumulated once, as in train, and X.T X = Q L Q.T
+    is diagonalized once; the solution for every reg is then
+    Q diag(1 / (L + N * reg)) Q.T X.T T, which costs O(D^2 * C) per reg
+    after the O(D^3) eigendecomposition, instead of a new O(D^3) solve.
+
+    Inputs:
+    - X, y, chunk_size: As for train.
+    - regs: A sequence of positive regularization strengths.
+    - feature_map: An optional feature map, fit on X and shared by all the
+      trained classifiers.
+    - dtype: The dtype of the weights, as for the constructor.
+
+    Returns a tuple of:
+    - models: A dictionary mapping each reg to a trained RidgeClassifier.
+    - losses: A dictionary mapping each reg to the training loss of its
+      model.
+    """
+    num_classes = np.max(y) + 1
+    if feature_map is not None:
+      _fit_feature_map(feature_map, X, dtype)
+    gram, targets = _ridge_statistics(X, y, num_classes, chunk_size,
+                                      feature_map)
+    num_train = X.shape[0]
+    eigenvalues, eigenvectors = eigh(gram, driver='evd')
+    projected = eigenvectors.T.dot(targets)
+    models = {}
+    losses = {}
+    for reg in regs:
+      scale = 1 / (eigenvalues + num_train * reg)
+      W = eigenvectors.dot(projected * scale[:, np.newaxis])
+      models[reg] = cls(feature_map, dtype)
+      models[reg].W = W.astype(dtype, copy=False)
+      losses[reg] = _ridge_objective(W, gram, targets, num_train, reg)
+    return models, losses
+
+  def loss(self, X_batch, y_batch, reg, workspace=None):
+    num_train = X_batch.shape[0]
+    residuals = X_batch.dot(self.W)
+    residuals[np.arange(num_train), y_batch] -= 1
+    loss = np.sum(residuals * residuals) / num_train
+    loss += reg * np.sum(self.W * self.W)
+    dW = 2 * X_batch.T.dot(residuals) / num_train + 2 * reg * self.W
+    return loss, dW
+
+
+def _ridge_statistics(X, y, num_classes, chunk_size, feature_map=None):
+  """
+  Accumulate X.T X and X.T T over chunks of rows of X, in float64, where T
+  is the one-hot encoding of y. With a feature map, the features of X are
+  used instead, computed one chunk at a time.
+
+  Returns a tuple of:
+  - gram: An array of shape (D, D) holding X.T X.
+  - targets: An array of shape (D, C) holding X.T T.
+  """
+  num_train = X.shape[0]
+  dim = X.shape[1] if feature_map is None else feature_map.num_features
+  gram = np.zeros((dim, dim))
+  targets = np.zeros((dim, num_classes))
+  for i0 in range(0, num_train, chunk_size):
+    chunk = X[i0:i0 + chunk_size]
+    if feature_map is not None:
+      chunk = feature_map.transform(chunk)
+    chunk = chunk.astype(np.float64, copy=False)
+    if issparse(chunk):
+      gram += chunk.T.dot(chunk).toarray()
+    else:
+      gram += chunk.T.dot(chunk)
+    one_hot = np.zeros((chunk.shape[0], num_classes))
+    one_hot[np.arange(chunk.shape[0]), y[i0:i0 + chunk_size]] = 1
+    targets += chunk.T.dot(one_hot)
+  return gram, targets
+
+
+def _ridge_objective(W, gram, targets, num_train, reg):
+  """
+  The ridge loss of W, from the statistics of _ridge_statistics: the squared
+  residuals expand to tr(W.T X.T X W) - 2 tr(W.T X.T T) + N, since every row
+  of T holds a single one.
+  """
+  data_loss = np.vdot(W, gram.dot(W)) - 2 * np.vdot(W, targets) + num_train
+  return data_loss / num_train + reg * np.vdot(W, W)
@@ -1,5 +1,9 @@
 import numpy as np
 from random import shuffle
+from scipy.linalg.blas import get_blas_funcs
+from scipy.sparse import csr_matrix, issparse
+
+from cs231n.workspace import dot_into, flat_label_indices, get_buffer
 
 def svm_loss_naive(W, X, y, reg):
   """
@@ -71,7 +75,8 @@ def svm_loss_vectorized(W, X, y, reg):
   """
   Structured SVM loss function, vectorized implementation.
 
-  Inputs and outputs are the same as svm_loss_naive.
+  Inputs and outputs are the same as svm_loss_naive; X may also be a
+  scipy.sparse CSR matrix.
   """
   loss = 0.0
   dW = np.zeros(W.shape) # initialize the gradient as zero
@@ -81,7 +86,7 @@ def svm_loss_vectorized(W, X, y, reg):
   # Implement a vectorized version of the structured SVM loss, storing the    #
   # result in loss.                                                           #
   #############################################################################
-  scores = np.dot(X,W)
+  scores = X.dot(W)
   # get correct scores for each training point
   correct_scores = scores[np.arange(X.shape[0]), y ].reshape(-1, 1)
   #subtract correct score from scores for each training point
@@ -125,7 +130,7 @@ def svm_loss_vectorized(W, X, y, reg):
   # Now remember: [X_col1 X_col2 *[A_row1
   #                                 A_row2]  = X_col1 * A_row1 + X_col2 *A_row2
   # This is exactly what we want except with X transposed. 
-  dW = np.dot(X.transpose(), scores)
+  dW = X.transpose().dot(scores)
   dW /= X.shape[0]
   dW += 2 * reg * W
   
@@ -134,3 +139,247 @@ def svm_loss_vectorized(W, X, y, reg):
   #############################################################################
 
   return loss, dW
+
+
+def svm_loss_inplace(W, X, y, reg, workspace):
+  """
+  Structured SVM loss function computing the same as svm_loss_vectorized
+  without allocating arrays once its workspace is warm: the scores, margin
+  coefficients and gradient live in buffers of the workspace and every step
+  runs in place.
+
+  Inputs:
+  - W, X, y, reg: As for svm_loss_vectorized.
+  - workspace: A dictionary, empty on the first call, that the caller passes
+    unchanged to every call.
+
+  Returns a tuple of:
+  - loss as single float
+  - gradient with respect to weights W; a buffer of the workspace that is
+    overwritten by the next call.
+  """
+  num_train = X.shape[0]
+  num_classes = W.shape[1]
+  labels = flat_label_indices(workspace, y, num_classes)
+  # the buffers take the dtype of the product of X and W, so that float32
+  # data and weights are never upcast
+  dtype = np.result_type(X.dtype, W.dtype)
+  scores = get_buffer(workspace, 'scores', (num_train, num_classes), dtype)
+  correct = get_buffer(workspace, 'correct_scores', (num_train, 1), dtype)
+  counts = get_buffer(workspace, 'margin_counts', (num_train,), dtype)
+  dW = get_buffer(workspace, 'dW', W.shape, dtype)
+  reg_grad = get_buffer(workspace, 'reg_grad', W.shape, dtype)
+
+  # margins, in place in scores
+  dot_into(X, W, scores)
+  np.take(scores, labels, out=correct.reshape(-1))
+  scores -= correct
+  scores += 1
+  np.put(scores, labels, 0)
+  np.maximum(scores, 0, out=scores)
+  loss = np.sum(scores) / num_train + reg * np.vdot(W, W)
+
+  # margin coefficients as in svm_loss_vectorized, in place in scores
+  np.greater(scores, 0, out=scores)
+  np.sum(scores, axis=1, out=counts)
+  np.negative(counts, out=counts)
+  np.put(scores, labels, counts)
+  scores /= num_train
+  dot_into(X.T, scores, dW)
+  np.multiply(W, 2 * reg, out=reg_grad)
+  dW += reg_grad
+  return loss, dW
+
+
+def svm_ovr_objective(W, X, y, reg):
+  """
+  One-vs-rest hinge loss, the objective minimized by
+  svm_dual_coordinate_descent: for each class c, the binary hinge loss of
+  telling class c from all others, averaged over the N examples and summed
+  over classes, plus reg * sum(W * W).
+
+  Inputs and outputs are the same as svm_loss_naive, except that only the
+  loss is returned.
+  """
+  signs = np.where(y.reshape(-1, 1) == np.arange(W.shape[1]), 1.0, -1.0)
+  margins = np.maximum(1 - signs * X.dot(W), 0)
+  return np.sum(margins) / X.shape[0] + reg * np.sum(W * W)
+
+
+def svm_dual_coordinate_descent(X, y, num_classes, reg, max_epochs=50,
+                                tol=0.1, shrinking=True, verbose=False):
+  """
+  Train one-vs-rest linear SVMs by dual coordinate descent with shrinking,
+  as in LIBLINEAR (Hsieh et al., "A Dual Coordinate Descent Method for
+  Large-scale Linear SVM", 2008).
+
+  For each class c the binary problem
+    min_w  reg * |w|^2 + 1/N * sum_i max(0, 1 - s_ic * x_i.w),
+  with s_ic = 1 if y_i = c and -1 otherwise, is the usual SVM
+  min_w 1/2 |w|^2 + C * sum_i max(0, 1 - s_ic * x_i.w) with
+  C = 1 / (2 * reg * N). Its dual has one variable per example in [0, C];
+  the solver visits the examples in a random order each epoch and minimizes
+  the dual exactly in each variable, keeping w up to date. The problems of all
+  classes share the examples, so they are solved together, one example at a
+  time. Variables stuck at a bound are shrunk (skipped) until the remaining
+  ones converge, after which convergence is verified on all of them.
+
+  Inputs:
+  - X: A numpy array or scipy.sparse matrix of shape (N, D) of training
+    data. For sparse data an update costs O(nonzeros of the example * C).
+  - y: A numpy array of shape (N,) of labels in 0 ... num_classes - 1.
+  - num_classes: The number of classes C.
+  - reg: (float) regularization strength.
+  - max_epochs: Maximum number of passes over the data.
+  - tol: Stop when the largest violation of the optimality conditions, the
+    spread of the projected gradients, falls below tol.
+  - shrinking: Whether to shrink variables at bounds.
+  - verbose: If true, print the objective after every epoch.
+
+  Returns a tuple of:
+  - W: A numpy array of shape (D, C) of weights.
+  - history: A list with the value of svm_ovr_objective after each epoch.
+  """
+  num_train, dim = X.shape
+  sparse = issparse(X)
+  if sparse:
+    X = csr_matrix(X, dtype=np.float64)
+    sq_norms = np.asarray(X.multiply(X).sum(axis=1)).ravel().tolist()
+  else:
+    X = np.ascontiguousarray(X, dtype=np.float64)
+    sq_norms = np.sum(X ** 2, axis=1).tolist()
+  upper = 1.0 / (2 * reg * num_train)
+  labels = y.tolist()
+  # the weights as a Fortran-ordered (D, C) array, so that BLAS ger can
+  # apply the rank-one update of an example to all classes in place
+  W = np.zeros((dim, num_classes), order='F')
+  W_rows = W.T
+  ger = get_blas_funcs('ger', (W,))
+
+  # The per-example work on the C dual variables is a handful of scalar
+  # operations, which are much cheaper on Python lists than as numpy calls
+  # on arrays of length C. alpha holds the dual variables, projected the
+  # projected gradients of the current epoch (zero for shrunk variables).
+  alpha = [[0.0] * num_classes for i in range(num_train)]
+  shrunk = [[False] * num_classes for i in range(num_train)]
+  projected = [[0.0] * num_classes for i in range(num_train)]
+  steps = [0.0] * num_classes
+  # bounds on the projected gradients of the previous epoch, per class
+  pg_max_old = [np.inf] * num_classes
+  pg_min_old = [-np.inf] * num_classes
+
+  history = []
+  for epoch in range(max_epochs):
+    active = [i for i in range(num_train) if not all(shrunk[i])]
+    for j in np.random.permutation(len(active)):
+      i = active[j]
+      q = sq_norms[i]
+      if q == 0:
+        continue
+      if sparse:
+        cols = X.indices[X.indptr[i]:X.indptr[i + 1]]
+        values = X.data[X.indptr[i]:X.indptr[i + 1]]
+        scores = values.dot(W[cols]).tolist()
+      else:
+        scores = W_rows.dot(X[i]).tolist()
+      a, sh, pg, label = alpha[i], shrunk[i], projected[i], labels[i]
+      update = False
+      for c in range(num_classes):
+        steps[c] = 0.0
+        pg[c] = 0.0
+        if sh[c]:
+          continue
+        sign = 1.0 if c == label else -1.0
+        G = sign * scores[c] - 1
+        if a[c] == 0:
+          if shrinking and G > pg_max_old[c]:
+            sh[c] = True
+            continue
+          PG = min(G, 0.0)
+        elif a[c] == upper:
+          if shrinking and G < pg_min_old[c]:
+            sh[c] = True
+            continue
+          PG = max(G, 0.0)
+        else:
+          PG = G
+        pg[c] = PG
+        if abs(PG) > 1e-12:
+          new_a = min(max(a[c] - G / q, 0.0), upper)
+          steps[c] = (new_a - a[c]) * sign
+          a[c] = new_a
+          update = True
+      if update and sparse:
+        W[cols] += np.outer(values, steps)
+      elif update:
+        ger(1.0, X[i], steps, a=W, overwrite_a=True)
+
+    epoch_pg = np.array([projected[i] for i in active])
+    pg_max = np.max(epoch_pg, axis=0)
+    pg_min = np.min(epoch_pg, axis=0)
+    history.append(svm_ovr_objective(W, X, y, reg))
+    if verbose:
+      print('epoch %d / %d: objective %f, %d active examples' % (
+        epoch, max_epochs, history[-1], len(active)))
+
+    if np.max(pg_max - pg_min) <= tol:
+      if len(active) == num_train and not any(map(any, shrunk)):
+        break
+      # converged on the active variables: check all of them again
+      shrunk = [[False] * num_classes for i in range(num_train)]
+      pg_max_old = [np.inf] * num_classes
+      pg_min_old = [-np.inf] * num_classes
+      continue
+    pg_max_old = [v if v > 0 else np.inf for v in pg_max.tolist()]
+    pg_min_old = [v if v < 0 else -np.inf for v in pg_min.tolist()]
+
+  return np.ascontiguousarray(W), history
+
+
+def svm_loss_batched(W, X, y, reg):
+  """
+  Structured SVM loss function for G models at once, all evaluated on the
+  same minibatch.
+
+  The scores of every model come from a single matrix product of X with the
+  weights laid out as a (D, G * C) matrix, and the gradient from a single
+  product of X.T with the (N, G * C) margin coefficients. This is cheapest
+  when W is a (G, D, C) view of a contiguous (D, G, C) array, as made by
+  LinearClassifier.train_grid; any other layout is copied once per call.
+
+  Inputs:
+  - W: A numpy array of shape (G, D, C) containing the weights of G models.
+  - X: A numpy array of shape (N, D) containing a minibatch of data.
+  - y: A numpy array of shape (N,) containing training labels.
+  - reg: (float) regularization strength, or an array of shape (G,) with one
+    strength per model.
+
+  Returns a tuple of:
+  - loss: A numpy array of shape (G,), loss[g] being what
+    svm_loss_vectorized(W[g], X, y, reg[g]) returns.
+  - gradient with respect to W; an array of shape (G, D, C) laid out like a
+    (D, G, C) array.
+  """
+  num_models, dim, num_classes = W.shape
+  num_train = X.shape[0]
+  reg = np.broadcast_to(np.asarray(reg, dtype=W.dtype), (num_models,))
+  W_flat = W.transpose(1, 0, 2).reshape(dim, num_models * num_classes)
+
+  scores = X.dot(W_flat).reshape(num_train, num_models, num_classes)
+  rows = np.arange(num_train)
+  margins = scores - scores[rows, :, y][:, :, np.newaxis] + 1
+  margins[rows, :, y] = 0
+  np.maximum(margins, 0, out=margins)
+
+  loss = np.sum(margins, axis=(0, 2)) / num_train
+  # the regularization terms are computed on the contiguous flat layout
+  sq_norms = np.einsum('ij,ij->j', W_flat, W_flat)
+  loss += reg * np.sum(sq_norms.reshape(num_models, num_classes), axis=1)
+
+  # margin coefficients as in svm_loss_vectorized, for every model
+  coeffs = (margins > 0).astype(margins.dtype)
+  coeffs[rows, :, y] = -np.sum(coeffs, axis=2)
+  dW = X.T.dot(coeffs.reshape(num_train, -1))
+  dW /= num_train
+  dW += 2 * np.repeat(reg, num_classes) * W_flat
+  return loss, dW.reshape(dim, num_models, num_classes).transpose(1, 0, 2)
@@ -20,7 +20,8 @@ class TwoLayerNet(object):
   The outputs of the second fully-connected layer are the scores for each class.
   """
 
-  def __init__(self, input_size, hidden_size, output_size, std=1e-4):
+  def __init__(self, input_size, hidden_size, output_size, std=1e-4,
+               dtype=np.float64):
     """
     Initialize the model. Weights are initialized to small random values and
     biases are initialized to zero. Weights and biases are stored in the
@@ -35,12 +36,17 @@ class TwoLayerNet(object):
     - input_size: The dimension D of the input data.
     - hidden_size: The number of neurons H in the hidden layer.
     - output_size: The number of classes C.
+    - dtype: The dtype of the parameters, np.float64 or np.float32; train
+      and predict convert their data to it, so that a float32 network runs
+      entirely in float32.
     """
     self.params = {}
-    self.params['W1'] = std * np.random.randn(input_size, hidden_size)
-    self.params['b1'] = np.zeros(hidden_size)
-    self.params['W2'] = std * np.random.randn(hidden_size, output_size)
-    self.params['b2'] = np.zeros(output_size)
+    W1 = std * np.random.randn(input_size, hidden_size)
+    W2 = std * np.random.randn(hidden_size, output_size)
+    self.params['W1'] = W1.astype(dtype)
+    self.params['b1'] = np.zeros(hidden_size, dtype=dtype)
+    self.params['W2'] = W2.astype(dtype)
+    self.params['b2'] = np.zeros(output_size, dtype=dtype)
 
   def loss(self, X, y=None, reg=0.0):
     """
@@ -178,6 +184,7 @@ class TwoLayerNet(object):
     """
     num_train = X.shape[0]
     iterations_per_epoch = max(num_train / batch_size, 1)
+    dtype = self.params['W1'].dtype
 
     # Use SGD to optimize the parameters in self.model
     loss_history = []
@@ -199,7 +206,8 @@ class TwoLayerNet(object):
       else: 
           selected_indices = np.random.choice(X.shape[0], batch_size, 
                                   replace=False)
-      X_batch = X[selected_indices, :]
+      # only the minibatch is converted to the dtype of the parameters
+      X_batch = X[selected_indices, :].astype(dtype, copy=False)
       y_batch = y[selected_indices]
       #########################################################################
       #                             END OF YOUR CODE                          #
@@ -263,6 +271,7 @@ class TwoLayerNet(object):
     ###########################################################################
     # TODO: Implement this function; it should be VERY simple!                #
     ###########################################################################
+    X = X.astype(self.params['W1'].dtype, copy=False)
     h1 = np.dot(X, self.params['W1'] ) + self.params['b1']
     h1 = np.clip(h1, a_min = 0, a_max=None)
     out = np.dot( h1, self.params['W2']) + self.params['b2'] 
@@ -1,6 +1,8 @@
 import numpy as np
 from random import shuffle
 
+from cs231n.workspace import dot_into, flat_label_indices, get_buffer
+
 def softmax_loss_naive(W, X, y, reg):
   """
   Softmax loss function, naive implementation (with loops)
@@ -48,6 +50,7 @@ def softmax_loss_naive(W, X, y, reg):
   loss /= X.shape[0]
   loss += reg * np.sum( W**2 )
   dW /= X.shape[0]
+  dW += 2 * reg * W
 
   return loss, dW
 
@@ -56,7 +59,8 @@ def softmax_loss_vectorized(W, X, y, reg):
   """
   Softmax loss function, vectorized version.
 
-  Inputs and outputs are the same as softmax_loss_naive.
+  Inputs and outputs are the same as softmax_loss_naive; X may also be a
+  scipy.sparse CSR matrix.
   """
   # Initialize the loss and gradient to zero.
   loss = 0.0
@@ -68,7 +72,7 @@ def softmax_loss_vectorized(W, X, y, reg):
   # here, it is easy to run into numeric instability. Don't forget the        #
   # regularization!                                                           #
   #############################################################################
-  scores = np.dot(X,W)
+  scores = X.dot(W)
   scores = np.exp (scores - np.max(scores, axis = 1).reshape(-1,1) )
   # normalize scores
   scores /= np.sum(scores, axis = 1).reshape(-1,1)
@@ -77,14 +81,15 @@ def softmax_loss_vectorized(W, X, y, reg):
   true_label_scores = scores[np.arange(X.shape[0]), y ]
   loss = np.sum ( -np.log ( true_label_scores ) )
   loss /= X.shape[0]
-  loss += np.sum (W**2)
+  loss += reg * np.sum (W**2)
   
   #compute gradient 
   # fix coefficient of scores
   scores[np.arange(X.shape[0]), y] -= 1
   # column - row view of matrix multiplication
-  dW = np.dot( X.transpose(), scores )
+  dW = X.transpose().dot(scores)
   dW /= X.shape[0]
+  dW += 2 * reg * W
   
   #############################################################################
   #                          END OF YOUR CODE                                 #
@@ -92,3 +97,139 @@ def softmax_loss_vectorized(W, X, y, reg):
 
   return loss, dW
 
+
+def softmax_hessian_product(W, X, reg, V, probs=None):
+  """
+  Product of the Hessian of the softmax loss at W with a direction V, for
+  second-order solvers such as Newton-CG.
+
+  For scores S = X.dot(V), the product is
+  X.T.dot(P * S - P * sum(P * S, axis=1)) / N + 2 * reg * V, where P holds the
+  softmax probabilities at W.
+
+  Inputs:
+  - W: A numpy array of shape (D, C) containing weights.
+  - X: A numpy array of shape (N, D) containing data.
+  - reg: (float) regularization strength.
+  - V: A numpy array of shape (D, C), the direction.
+  - probs: Optionally, the (N, C) probabilities at W, which do not depend
+    on V and can be shared by all products at the same W.
+
+  Returns:
+  - The product, an array of shape (D, C).
+  """
+  if probs is None:
+    probs = softmax_probabilities(W, X)
+  PS = probs * X.dot(V)
+  PS -= probs * np.sum(PS, axis=1, keepdims=True)
+  return X.T.dot(PS) / X.shape[0] + 2 * reg * V
+
+
+def softmax_probabilities(W, X):
+  """
+  Softmax probabilities of the classes, an array of shape (N, C), for
+  weights W of shape (D, C) and data X of shape (N, D).
+  """
+  scores = X.dot(W)
+  scores -= np.max(scores, axis=1, keepdims=True)
+  np.exp(scores, out=scores)
+  scores /= np.sum(scores, axis=1, keepdims=True)
+  return scores
+
+
+def softmax_loss_inplace(W, X, y, reg, workspace):
+  """
+  Softmax loss function computing the same as softmax_loss_vectorized
+  without allocating arrays once its workspace is warm: exp, normalization
+  and the gradient of the scores run in place in buffers of the workspace.
+
+  Inputs:
+  - W, X, y, reg: As for softmax_loss_vectorized.
+  - workspace: A dictionary, empty on the first call, that the caller passes
+    unchanged to every call.
+
+  Returns a tuple of:
+  - loss as single float
+  - gradient with respect to weights W; a buffer of the workspace that is
+    overwritten by the next call.
+  """
+  num_train = X.shape[0]
+  num_classes = W.shape[1]
+  labels = flat_label_indices(workspace, y, num_classes)
+  # the buffers take the dtype of the product of X and W, so that float32
+  # data and weights are never upcast
+  dtype = np.result_type(X.dtype, W.dtype)
+  scores = get_buffer(workspace, 'scores', (num_train, num_classes), dtype)
+  row_stat = get_buffer(workspace, 'row_stat', (num_train, 1), dtype)
+  probs = get_buffer(workspace, 'correct_probs', (num_train,), dtype)
+  dW = get_buffer(workspace, 'dW', W.shape, dtype)
+  reg_grad = get_buffer(workspace, 'reg_grad', W.shape, dtype)
+
+  # probabilities, in place in scores
+  dot_into(X, W, scores)
+  np.max(scores, axis=1, keepdims=True, out=row_stat)
+  scores -= row_stat
+  np.exp(scores, out=scores)
+  np.sum(scores, axis=1, keepdims=True, out=row_stat)
+  scores /= row_stat
+
+  # gradient of the scores: probabilities minus one at the labels
+  np.take(scores, labels, out=probs)
+  np.subtract(probs, 1, out=row_stat.reshape(-1))
+  np.put(scores, labels, row_stat)
+  np.log(probs, out=probs)
+  loss = -np.sum(probs) / num_train + reg * np.vdot(W, W)
+
+  scores /= num_train
+  dot_into(X.T, scores, dW)
+  np.multiply(W, 2 * reg, out=reg_grad)
+  dW += reg_grad
+  return loss, dW
+
+
+def softmax_loss_batched(W, X, y, reg):
+  """
+  Softmax loss function for G models at once, all evaluated on the same
+  minibatch.
+
+  The scores of every model come from a single matrix product of X with the
+  weights laid out as a (D, G * C) matrix, and the gradient from a single
+  product of X.T with the (N, G * C) score gradients. This is cheapest when
+  W is a (G, D, C) view of a contiguous (D, G, C) array, as made by
+  LinearClassifier.train_grid; any other layout is copied once per call.
+
+  Inputs:
+  - W: A numpy array of shape (G, D, C) containing the weights of G models.
+  - X: A numpy array of shape (N, D) containing a minibatch of data.
+  - y: A numpy array of shape (N,) containing training labels.
+  - reg: (float) regularization strength, or an array of shape (G,) with one
+    strength per model.
+
+  Returns a tuple of:
+  - loss: A numpy array of shape (G,), loss[g] being what
+    softmax_loss_vectorized(W[g], X, y, reg[g]) returns.
+  - gradient with respect to W; an array of shape (G, D, C) laid out like a
+    (D, G, C) array.
+  """
+  num_models, dim, num_classes = W.shape
+  num_train = X.shape[0]
+  reg = np.broadcast_to(np.asarray(reg, dtype=W.dtype), (num_models,))
+  W_flat = W.transpose(1, 0, 2).reshape(dim, num_models * num_classes)
+
+  scores = X.dot(W_flat).reshape(num_train, num_models, num_classes)
+  scores -= np.max(scores, axis=2, keepdims=True)
+  np.exp(scores, out=scores)
+  scores /= np.sum(scores, axis=2, keepdims=True)
+
+  rows = np.arange(num_train)
+  loss = -np.sum(np.log(scores[rows, :, y]), axis=0) / num_train
+  # the regularization terms are computed on the contiguous flat layout
+  sq_norms = np.einsum('ij,ij->j', W_flat, W_flat)
+  loss += reg * np.sum(sq_norms.reshape(num_models, num_classes), axis=1)
+
+  scores[rows, :, y] -= 1
+  dW = X.T.dot(scores.reshape(num_train, -1))
+  dW /= num_train
+  dW += 2 * np.repeat(reg, num_classes) * W_flat
+  return loss, dW.reshape(dim, num_models, num_classes).transpose(1, 0, 2)
+
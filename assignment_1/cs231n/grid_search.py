@@ -0,0 +1,199 @@
+from __future__ import print_function
+
+import itertools
+import multiprocessing
+import os
+import time
+import warnings
+
+import numpy as np
+
+from cs231n.shared_arrays import attach_array, release, share_array
+
+try:
+  from threadpoolctl import threadpool_limits
+except ImportError:
+  threadpool_limits = None
+
+# Environment variables read by the BLAS and OpenMP runtimes numpy may use.
+BLAS_THREAD_VARIABLES = ('OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS',
+                         'MKL_NUM_THREADS', 'VECLIB_MAXIMUM_THREADS',
+                         'NUMEXPR_NUM_THREADS')
+
+
+def grid_search(train_fn, param_grid, X_train, y_train, X_val, y_val,
+                n_jobs=None, blas_threads=1, start_method=None,
+                verbose=False):
+  """
+  Train and evaluate one model per point of a hyperparameter grid in a pool
+  of processes.
+
+  The training and validation data are placed in shared memory once and
+  mapped by every worker, so nothing of the size of the data is pickled per
+  configuration. Each worker limits BLAS to blas_threads threads, so that
+  n_jobs workers do not oversubscribe the cores; with the default of one
+  thread per worker and one worker per core, throughput scales close to
+  linearly with the number of cores.
+
+  For example, the TwoLayerNet sweep of two_layer_net.ipynb becomes:
+
+    def train_net(params, X_train, y_train, X_val, y_val):
+      net = TwoLayerNet(X_train.shape[1], params['hidden_size'], 10)
+      net.train(X_train, y_train, X_val, y_val, num_iters=1500,
+                learning_rate=params['learning_rate'], reg=params['reg'])
+      return net
+
+    param_grid = {'hidden_size': [50, 100, 150],
+                  'learning_rate': [1e-3, 2e-3], 'reg': [0.1, 0.5]}
+    results, best_net = grid_search(train_net, param_grid,
+                                    X_train, y_train, X_val, y_val)
+
+  Inputs:
+  - train_fn: A function train_fn(params, X_train, y_train, X_val, y_val)
+    returning a trained model with a predict method. It must be picklable,
+    that is defined at the top level of a module (or of the notebook when
+    the pool forks); the data arrays it receives are read-only.
+  - param_grid: A dictionary mapping each parameter name to a list of
+    values; every combination of values is one configuration. The grid is
+    ordered like nested loops over the parameters in the order of the
+    dictionary.
+  - X_train, y_train, X_val, y_val: Training and validation data.
+  - n_jobs: Number of worker processes; defaults to the number of cores.
+  - blas_threads: Number of BLAS threads per worker.
+  - start_method: multiprocessing start method ('fork', 'spawn' or
+    'forkserver'), or None for the platform default ('fork' on Linux). How
+    each one limits BLAS threads is described in blas_limited_pool.
+  - verbose: If true, print one line per finished configuration.
+
+  Returns a tuple of:
+  - results: A list with one dictionary per configuration, in grid order,
+    with the keys 'params', 'train_accuracy', 'val_accuracy' and 'time'
+    (seconds spent in train_fn).
+  - best_model: The model with the highest validation accuracy, the first
+    one in grid order if several tie.
+  """
+  names = list(param_grid)
+  configs = [dict(zip(names, values)) for values in
+             itertools.product(*[param_grid[name] for name in names])]
+  if n_jobs is None:
+    n_jobs = multiprocessing.cpu_count()
+  n_jobs = max(min(n_jobs, len(configs)), 1)
+
+  blocks = []
+  specs = []
+  try:
+    for arr in (X_train, y_train, X_val, y_val):
+      shm, spec = share_array(arr)
+      blocks.append(shm)
+      specs.append(spec)
+    pool = blas_limited_pool(n_jobs, _init_search_worker, (train_fn, specs),
+                             blas_threads, start_method)
+    try:
+      results = [None] * len(configs)
+      best_model = None
+      best_key = None
+      for i, result, model in pool.imap_unordered(_search_worker_config,
+                                                  enumerate(configs)):
+        results[i] = result
+        # only the best model so far is kept
+        key = (-result['val_accuracy'], i)
+        if best_key is None or key < best_key:
+          best_key = key
+          best_model = model
+        if verbose:
+          print('%s train accuracy: %f val accuracy: %f (%.1fs)' % (
+            result['params'], result['train_accuracy'],
+            result['val_accuracy'], result['time']))
+    finally:
+      pool.close()
+      pool.join()
+  finally:
+    release(blocks)
+  return results, best_model
+
+
+def blas_limited_pool(n_jobs, initializer, initargs, blas_threads=1,
+                      start_method=None):
+  """
+  Start a multiprocessing pool whose workers limit BLAS to blas_threads
+  threads each, so that n_jobs workers running matrix products do not
+  oversubscribe the cores.
+
+  Workers that are not forked read the limit from the environment when they
+  import numpy; it is set only while the pool starts. Forked workers inherit
+  an initialized BLAS and are limited through threadpoolctl (see
+  requirements.txt); without it they run BLAS on every core, and a warning
+  is issued.
+
+  Inputs:
+  - n_jobs: Number of worker processes.
+  - initializer, initargs: Called as initializer(*initargs) in every worker
+    once its BLAS is limited.
+  - blas_threads: Number of BLAS threads per worker.
+  - start_method: multiprocessing start method, or None for the platform
+    default ('fork' on Linux).
+
+  Returns:
+  - pool: The multiprocessing.Pool; the caller closes and joins it.
+  """
+  context = multiprocessing.get_context(start_method)
+  if threadpool_limits is None and context.get_start_method() == 'fork':
+    warnings.warn('threadpoolctl is not installed, so forked workers cannot '
+                  'limit BLAS to %d threads and may oversubscribe the '
+                  'cores; install threadpoolctl or pass '
+                  "start_method='forkserver'" % blas_threads)
+  saved_env = dict((name, os.environ.get(name))
+                   for name in BLAS_THREAD_VARIABLES)
+  try:
+    for name in BLAS_THREAD_VARIABLES:
+      os.environ[name] = str(blas_threads)
+    return context.Pool(n_jobs, initializer=_init_blas_limited_worker,
+                        initargs=(blas_threads, initializer, initargs))
+  finally:
+    for name, value in saved_env.items():
+      if value is None:
+        os.environ.pop(name, None)
+      else:
+        os.environ[name] = value
+
+
+# Limits of the BLAS of a worker of blas_limited_pool, kept alive for the
+# lifetime of the worker.
+_blas_limits = []
+
+
+def _init_blas_limited_worker(blas_threads, initializer, initargs):
+  if threadpool_limits is not None:
+    _blas_limits.append(threadpool_limits(limits=blas_threads))
+  initializer(*initargs)
+
+
+# State of a grid search worker process, set up by _init_search_worker.
+_worker = {}
+
+
+def _init_search_worker(train_fn, specs):
+  _worker['train_fn'] = train_fn
+  _worker['blocks'] = []
+  arrays = []
+  for spec in specs:
+    shm, arr = attach_array(spec)
+    arr.flags.writeable = False
+    _worker['blocks'].append(shm)
+    arrays.append(arr)
+  _worker['data'] = arrays
+
+
+def _search_worker_config(task):
+  i, params = task
+  X_train, y_train, X_val, y_val = _worker['data']
+  tic = time.time()
+  model = _worker['train_fn'](params, X_train, y_train, X_val, y_val)
+  train_time = time.time() - tic
+  result = {
+    'params': params,
+    'train_accuracy': np.mean(model.predict(X_train) == y_train),
+    'val_accuracy': np.mean(model.predict(X_val) == y_val),
+    'time': train_time,
+  }
+  return i, result, model
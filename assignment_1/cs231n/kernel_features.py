@@ -0,0 +1,209 @@
+import numpy as np
+from scipy.sparse import issparse
+
+from cs231n.workspace import dot_into
+
+# Number of rows used to pick the default RBF bandwidth.
+GAMMA_SAMPLE_SIZE = 1000
+
+
+class _KernelFeatureMap(object):
+  """
+  Common code of the explicit feature maps approximating the RBF kernel
+  k(x, z) = exp(-gamma * ||x - z||^2): features z(x) of dimension F such
+  that z(x).dot(z(z')) is close to k(x, z'), so that a linear classifier
+  trained on the features approximates a kernel machine. Training and
+  prediction then cost O(N * F) per pass instead of the O(N^2) of the
+  kernel matrix.
+
+  A map is fit once on the training data and then transforms any number of
+  points, chunk_size rows at a time, into a preallocated output. The
+  features are computed in dtype; each chunk of input of another dtype is
+  converted to it first.
+  """
+
+  def __init__(self, num_features, gamma, seed, chunk_size, dtype):
+    self.num_features = num_features
+    self.gamma = gamma
+    self.seed = seed
+    self.chunk_size = chunk_size
+    self.dtype = dtype
+
+  def fit(self, X):
+    """
+    Draw the parameters of the feature map.
+
+    Inputs:
+    - X: A numpy array or scipy.sparse matrix of shape (N, D) of training
+      data.
+
+    Returns:
+    - self
+    """
+    rng = np.random.RandomState(self.seed)
+    if self.gamma is None:
+      self.kernel_gamma = _default_gamma(X, rng)
+    else:
+      self.kernel_gamma = float(self.gamma)
+    self._fit(X, rng)
+    return self
+
+  def transform(self, X, out=None):
+    """
+    Compute the features of points.
+
+    Inputs:
+    - X: A numpy array (such as a np.memmap) or scipy.sparse matrix of shape
+      (N, D); it is read chunk_size rows at a time.
+    - out: An optional array of shape (N, F) and of dtype self.dtype
+      receiving the features.
+
+    Returns:
+    - features: An array of shape (N, F); this is out, if given.
+    """
+    num_points = X.shape[0]
+    if out is None:
+      out = np.empty((num_points, self.num_features), dtype=self.dtype)
+    workspace = {}
+    for i0 in range(0, num_points, self.chunk_size):
+      i1 = min(i0 + self.chunk_size, num_points)
+      block = X[i0:i1]
+      if block.dtype != self.dtype:
+        block = block.astype(self.dtype)
+      self._transform_block(block, out[i0:i1], workspace)
+    return out
+
+
+class RandomFourierFeatures(_KernelFeatureMap):
+  """
+  Random Fourier features (Rahimi and Recht, 2007): the RBF kernel is the
+  expectation of 2 cos(w.x + b) cos(w.z + b) over w ~ N(0, 2 * gamma * I)
+  and b ~ U(0, 2 pi), and the map averages num_features such terms. The
+  approximation error decreases as 1 / sqrt(num_features), independently
+  of the training data.
+  """
+
+  def __init__(self, num_features=2000, gamma=None, seed=0, chunk_size=4096,
+               dtype=np.float64):
+    """
+    Inputs:
+    - num_features: Number F of random features.
+    - gamma: Bandwidth of the RBF kernel; defaults to the inverse of the
+      mean squared distance between training points.
+    - seed: Seed for the random frequencies and phases.
+    - chunk_size: Number of rows transformed at a time.
+    - dtype: The dtype of the features, np.float64 or np.float32; a
+      classifier fitting the map sets it to the dtype of its weights.
+    """
+    super(RandomFourierFeatures, self).__init__(num_features, gamma, seed,
+                                                chunk_size, dtype)
+
+  def _fit(self, X, rng):
+    dim = X.shape[1]
+    self.frequencies = rng.normal(0, np.sqrt(2 * self.kernel_gamma),
+                                  (dim, self.num_features)).astype(self.dtype)
+    self.phases = rng.uniform(0, 2 * np.pi,
+                              self.num_features).astype(self.dtype)
+
+  def _transform_block(self, X, out, workspace):
+    dot_into(X, self.frequencies, out)
+    out += self.phases
+    np.cos(out, out=out)
+    out *= np.sqrt(2.0 / self.num_features)
+
+
+class NystroemFeatures(_KernelFeatureMap):
+  """
+  Nystroem features (Williams and Seeger, 2001): for a fixed set of m
+  landmark points L, the features of x are k(x, L) K_LL^(-1/2), where K_LL
+  is the kernel matrix of the landmarks, so that the feature inner products
+  are the kernel restricted to the span of the landmarks. Since the
+  landmarks are drawn from the data, fewer features are usually needed than
+  with random Fourier features for the same accuracy.
+  """
+
+  def __init__(self, num_features=1000, gamma=None, seed=0, landmarks=None,
+               chunk_size=4096, dtype=np.float64):
+    """
+    Inputs:
+    - num_features: Number m of landmarks, and of features.
+    - gamma: Bandwidth of the RBF kernel; defaults to the inverse of the
+      mean squared distance between training points.
+    - seed: Seed for drawing the landmarks.
+    - landmarks: An optional numpy array of shape (m, D) of fixed landmarks;
+      by default, num_features distinct training points are drawn.
+    - chunk_size: Number of rows transformed at a time.
+    - dtype: The dtype of the features, np.float64 or np.float32; a
+      classifier fitting the map sets it to the dtype of its weights.
+    """
+    if landmarks is not None:
+      num_features = landmarks.shape[0]
+    super(NystroemFeatures, self).__init__(num_features, gamma, seed,
+                                           chunk_size, dtype)
+    self.landmarks = landmarks
+
+  def _fit(self, X, rng):
+    if self.landmarks is None:
+      if self.num_features > X.shape[0]:
+        raise ValueError('Cannot draw %d landmarks from %d points' % (
+          self.num_features, X.shape[0]))
+      chosen = np.sort(rng.choice(X.shape[0], self.num_features,
+                                  replace=False))
+      landmarks = X[chosen]
+      if issparse(landmarks):
+        landmarks = landmarks.toarray()
+      self.landmarks = landmarks
+    self.landmarks = np.asarray(self.landmarks, dtype=np.float64)
+    self.landmark_sq_norms = np.sum(self.landmarks ** 2, axis=1)
+    kernel = np.empty((self.num_features, self.num_features))
+    self._kernel_block(self.landmarks, self.landmark_sq_norms, kernel)
+    # K_LL^(-1/2), dropping the directions of numerically zero eigenvalues;
+    # it is computed in float64 whatever the dtype of the features
+    values, vectors = np.linalg.eigh(kernel)
+    keep = values > values.max() * 1e-10
+    self.normalization = np.dot(vectors[:, keep] / np.sqrt(values[keep]),
+                                vectors[:, keep].T).astype(self.dtype)
+    # the landmarks are then kept in the dtype of the features, so that
+    # transforming a chunk converts nothing
+    self.landmarks = self.landmarks.astype(self.dtype, copy=False)
+    self.landmark_sq_norms = self.landmark_sq_norms.astype(self.dtype,
+                                                           copy=False)
+
+  def _kernel_block(self, X, sq_norms, out):
+    # exp(-gamma * (||x||^2 - 2 x.l + ||l||^2)), in place in out
+    dot_into(X, self.landmarks.T, out)
+    out *= -2
+    out += sq_norms.reshape(-1, 1)
+    out += self.landmark_sq_norms
+    np.maximum(out, 0, out=out)
+    out *= -self.kernel_gamma
+    np.exp(out, out=out)
+
+  def _transform_block(self, X, out, workspace):
+    kernel = workspace.get('kernel')
+    if kernel is None or kernel.shape[0] != X.shape[0]:
+      kernel = workspace['kernel'] = np.empty((X.shape[0], self.num_features),
+                                              dtype=self.dtype)
+    self._kernel_block(X, _row_sq_norms(X), kernel)
+    np.dot(kernel, self.normalization, out=out)
+
+
+def _row_sq_norms(X):
+  if issparse(X):
+    return np.asarray(X.multiply(X).sum(axis=1), dtype=np.float64).ravel()
+  return np.einsum('ij,ij->i', X, X, dtype=np.float64)
+
+
+def _default_gamma(X, rng):
+  """
+  Inverse of the mean squared distance between two points of a sample of
+  the rows of X; the mean over all pairs is 2 (E||x||^2 - ||E x||^2).
+  """
+  num_points = X.shape[0]
+  if num_points > GAMMA_SAMPLE_SIZE:
+    X = X[np.sort(rng.choice(num_points, GAMMA_SAMPLE_SIZE, replace=False))]
+  mean = np.asarray(X.mean(axis=0), dtype=np.float64).ravel()
+  mean_sq_dist = 2 * (np.mean(_row_sq_norms(X)) - np.dot(mean, mean))
+  if mean_sq_dist <= 0:
+    return 1.0
+  return 1.0 / mean_sq_dist
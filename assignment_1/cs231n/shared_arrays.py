@@ -0,0 +1,139 @@
+from collections import namedtuple
+
+import numpy as np
+
+try:
+  from multiprocessing import shared_memory
+except ImportError:
+  # Python < 3.8: this module imports, but sharing arrays raises
+  shared_memory = None
+
+# Everything a worker process needs to find a shared array: the name of the
+# shared memory block, and the shape and dtype of the array stored in it.
+SharedArraySpec = namedtuple('SharedArraySpec', ['name', 'shape', 'dtype'])
+
+# An object whose attributes were moved to shared memory by share_attributes.
+SharedObjectSpec = namedtuple('SharedObjectSpec', ['cls', 'state'])
+
+
+def share_array(arr):
+  """
+  Copy an array into a new block of shared memory.
+
+  Inputs:
+  - arr: A numpy array.
+
+  Returns a tuple of:
+  - shm: The multiprocessing.shared_memory.SharedMemory block. The caller
+    owns it and must close() and unlink() it once the workers are done.
+  - spec: A SharedArraySpec that can be sent to worker processes, which
+    rebuild the array with attach_array without copying it.
+  """
+  _check_shared_memory()
+  arr = np.asarray(arr)
+  shm = shared_memory.SharedMemory(create=True, size=max(arr.nbytes, 1))
+  view = np.ndarray(arr.shape, dtype=arr.dtype, buffer=shm.buf)
+  view[...] = arr
+  return shm, SharedArraySpec(shm.name, arr.shape, arr.dtype.str)
+
+
+def attach_array(spec):
+  """
+  Map an array created by share_array into this process.
+
+  Inputs:
+  - spec: A SharedArraySpec.
+
+  Returns a tuple of:
+  - shm: The SharedMemory block; it must stay referenced as long as the
+    array is in use, and be close()d (not unlinked) afterwards.
+  - arr: A numpy array backed by the shared block.
+  """
+  _check_shared_memory()
+  shm = shared_memory.SharedMemory(name=spec.name)
+  arr = np.ndarray(spec.shape, dtype=np.dtype(spec.dtype), buffer=shm.buf)
+  return shm, arr
+
+
+def _check_shared_memory():
+  if shared_memory is None:
+    raise ImportError('multiprocessing.shared_memory, which n_jobs and '
+                      'grid_search use, needs Python 3.8 or later')
+
+
+def share_attributes(obj, _shared=None):
+  """
+  Describe an object so that worker processes can rebuild it with its
+  arrays in shared memory.
+
+  Every numpy array attribute is copied to shared memory, once even if
+  several attributes refer to it. Attributes that are themselves objects of
+  this package (such as a search index) are handled recursively; all other
+  attributes are sent as they are. Private attributes (starting with an
+  underscore, such as caches and spare buffer capacity) are left out.
+
+  Inputs:
+  - obj: The object to share.
+
+  Returns a tuple of:
+  - spec: A picklable SharedObjectSpec to pass to attach_attributes.
+  - blocks: A list of the SharedMemory blocks created, owned by the caller.
+  """
+  # arrays already shared, by id, across the recursive calls
+  if _shared is None:
+    _shared = {}
+  state = {}
+  blocks = []
+  for name, value in vars(obj).items():
+    if name.startswith('_'):
+      continue
+    if isinstance(value, np.ndarray):
+      if id(value) not in _shared:
+        shm, _shared[id(value)] = share_array(value)
+        blocks.append(shm)
+      value = _shared[id(value)]
+    elif type(value).__module__.startswith('cs231n'):
+      value, nested = share_attributes(value, _shared)
+      blocks += nested
+    state[name] = value
+  return SharedObjectSpec(type(obj), state), blocks
+
+
+def attach_attributes(spec):
+  """
+  Rebuild an object described by share_attributes without calling its
+  constructor.
+
+  Inputs:
+  - spec: A SharedObjectSpec.
+
+  Returns a tuple of:
+  - obj: The rebuilt object, whose array attributes live in shared memory.
+  - blocks: A list of the attached SharedMemory blocks, to keep referenced
+    while obj is in use.
+  """
+  obj = spec.cls.__new__(spec.cls)
+  blocks = []
+  for name, value in spec.state.items():
+    if isinstance(value, SharedArraySpec):
+      shm, value = attach_array(value)
+      blocks.append(shm)
+    elif isinstance(value, SharedObjectSpec):
+      value, nested = attach_attributes(value)
+      blocks += nested
+    setattr(obj, name, value)
+  return obj, blocks
+
+
+def release(blocks, unlink=True):
+  """
+  Close shared memory blocks and, if unlink, free them.
+
+  Inputs:
+  - blocks: A list of SharedMemory blocks.
+  - unlink: Whether to destroy the blocks; only their creator should.
+  """
+  for shm in blocks:
+    shm.close()
+    if unlink:
+      shm.unlink()
@@ -0,0 +1,65 @@
+import numpy as np
+from scipy.sparse import issparse
+
+
+def get_buffer(workspace, name, shape, dtype=np.float64):
+  """
+  Get a scratch array from a workspace, allocating it only the first time or
+  when the requested shape or dtype changes.
+
+  A workspace is a plain dictionary owned by the caller, such as a training
+  loop, and passed to every call of a loss function, so that the arrays those
+  calls need are allocated once instead of on every call.
+
+  Inputs:
+  - workspace: A dictionary mapping names to arrays.
+  - name: Name of the buffer.
+  - shape: Shape of the buffer.
+  - dtype: Data type of the buffer.
+
+  Returns:
+  - An array of the given shape and dtype with arbitrary contents.
+  """
+  buf = workspace.get(name)
+  if buf is None or buf.shape != tuple(shape) or buf.dtype != dtype:
+    buf = workspace[name] = np.empty(shape, dtype=dtype)
+  return buf
+
+
+def dot_into(A, B, out):
+  """
+  Store the matrix product A.dot(B) in out. Dense products are computed in
+  place; if A is a scipy.sparse matrix the product, whose cost scales with
+  the number of nonzeros of A, is computed and then copied.
+  """
+  if issparse(A):
+    out[...] = A.dot(B)
+  else:
+    np.dot(A, B, out=out)
+  return out
+
+
+def flat_label_indices(workspace, y, num_classes):
+  """
+  Positions of the entries scores[i, y[i]] in a raveled (N, C) scores array,
+  so that they can be read with np.take and written with np.put without the
+  temporary arrays of fancy indexing.
+
+  Inputs:
+  - workspace: A dictionary mapping names to arrays.
+  - y: A numpy array of shape (N,) of labels.
+  - num_classes: The number of columns C of the scores.
+
+  Returns:
+  - An array of shape (N,) holding i * C + y[i]; it lives in the workspace
+    and is overwritten by the next call.
+  """
+  num_train = y.shape[0]
+  offsets = workspace.get('row_offsets')
+  if offsets is None or offsets.shape[0] != num_train or \
+     workspace.get('row_offsets_classes') != num_classes:
+    offsets = workspace['row_offsets'] = np.arange(num_train) * num_classes
+    workspace['row_offsets_classes'] = num_classes
+  indices = get_buffer(workspace, 'label_indices', (num_train,), np.intp)
+  np.add(offsets, y, out=indices)
+  return indices